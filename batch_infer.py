@@ -0,0 +1,178 @@
+import csv
+import logging
+import multiprocessing
+import os
+import time
+
+import librosa
+import soundfile
+import torch
+
+from inference import infer_tool
+from inference.infer_tool import Svc
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.m4a')
+
+# one model per worker process, created by init_worker
+svc_model = None
+settings = None
+
+
+def find_jobs(args):
+    # (source, refer, tran) with paths below input_dir, from the manifest or every audio file x refer x trans
+    if args.manifest:
+        jobs = []
+        with open(args.manifest, newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith('#') or row[0] == 'source':
+                    continue
+                trans = [int(row[2])] if len(row) > 2 and row[2].strip() else args.trans
+                jobs.extend((row[0].strip(), row[1].strip() if len(row) > 1 and row[1].strip() else args.refer, tran) for tran in trans)
+        return jobs
+    sources = sorted(os.path.relpath(path, args.input_dir) for extension in AUDIO_EXTENSIONS
+                     for path in infer_tool.get_end_file(args.input_dir, extension))
+    return [(source, args.refer, tran) for source in sources if source != os.path.normpath(args.refer) for tran in args.trans]
+
+
+def output_path(args, job):
+    source, refer, tran = job
+    key = "auto" if args.auto_predict_f0 else f"{tran}key"
+    name = f"{os.path.splitext(source)[0]}_{key}_{os.path.splitext(os.path.basename(refer))[0]}.{args.wav_format}"
+    return os.path.join(args.output_dir, name)
+
+
+def duration(path):
+    try:
+        return soundfile.info(path).duration
+    except RuntimeError:
+        return librosa.get_duration(path=path)
+
+
+def init_worker(args, counter):
+    global svc_model, settings
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    # the cores are shared between the workers, gpus are handed out round robin
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    device = args.device[index % len(args.device)] if args.device else None
+    settings = args
+    svc_model = Svc(args.model_path, args.config_path, device,
+                    feature_cache=args.feature_cache, feature_cache_bytes=int(args.feature_cache_gb * 1024 ** 3))
+
+
+def convert(job):
+    source, refer, tran = job
+    path = output_path(settings, job)
+    start = time.time()
+    try:
+        audio = svc_model.slice_inference(os.path.join(settings.input_dir, source),
+                                          svc_model.load_audio(os.path.join(settings.input_dir, refer)),
+                                          tran,
+                                          settings.slice_db,
+                                          settings.auto_predict_f0,
+                                          pad_seconds=settings.pad_seconds,
+                                          clip_seconds=settings.clip,
+                                          lg_num=settings.linear_gradient,
+                                          lgr_num=settings.linear_gradient_retain,
+                                          F0_mean_pooling=settings.f0_mean_pooling,
+                                          cr_threshold=settings.f0_filter_threshold,
+                                          sample_method=settings.sample_method,
+                                          sampling_timesteps=settings.sampling_timesteps)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # only finished files carry the final name, so a restart redoes whatever was cut off
+        part = f"{path}.{os.getpid()}.part"
+        soundfile.write(part, audio, svc_model.target_sample, format=settings.wav_format)
+        os.replace(part, path)
+        svc_model.clear_empty()
+    except Exception as e:
+        logging.exception(f'{source} failed')
+        return job, None, time.time() - start, str(e)
+    return job, len(audio) / svc_model.target_sample, time.time() - start, None
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='convert a folder or a manifest of jobs with several worker processes, finished jobs are skipped on restart')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-i', '--input_dir', type=str, default="raw",
+                        help='Folder of the sources. Without a manifest every audio file below it is converted, manifest paths are relative to it.')
+    parser.add_argument('-o', '--output_dir', type=str, default="output/batch",
+                        help='Results keep the folder layout of the sources.')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='CSV of source,refer,tran rows. Empty refer or tran columns take -r and -t.')
+    parser.add_argument('-r', '--refer', type=str, default="1.wav",
+                        help='Reference audio, relative to the input folder.')
+    parser.add_argument('-t', '--trans', type=int, nargs='+', default=[0],
+                        help='Pitch adjustments in semitones, every source is converted once per value.')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Worker processes, each loads the model once and gets its share of the cpu threads.')
+    parser.add_argument('-d', '--device', type=str, nargs='+', default=None,
+                        help='Devices handed to the workers round robin. None means auto selecting.')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Convert jobs whose output exists already.')
+    parser.add_argument('-a', '--auto_predict_f0', action='store_true', default=False,
+                        help='Automatic pitch prediction for voice conversion. Do not enable this when converting songs as it can cause serious pitch issues.')
+    parser.add_argument('-cl', '--clip', type=float, default=0,
+                        help='Voice forced slicing. Set to 0 to turn off(default), duration in seconds.')
+    parser.add_argument('-lg', '--linear_gradient', type=float, default=0,
+                        help='The cross fade length of two audio slices in seconds.')
+    parser.add_argument('-lgr', '--linear_gradient_retain', type=float, default=0.75,
+                        help='Proportion of cross length retention, range (0-1].')
+    parser.add_argument('-fmp', '--f0_mean_pooling', action='store_true', default=False,
+                        help='Apply mean filter (pooling) to f0, which may improve some hoarse sounds.')
+    parser.add_argument('-ft', '--f0_filter_threshold', type=float, default=0.05,
+                        help='F0 Filtering threshold, only used with f0_mean_pooling.')
+    parser.add_argument('-sd', '--slice_db', type=int, default=-40,
+                        help='Loudness for automatic slicing. For noisy audio it can be set to -30')
+    parser.add_argument('-p', '--pad_seconds', type=float, default=0.5,
+                        help='Silence padded around every slice.')
+    parser.add_argument('-wf', '--wav_format', type=str, default='wav',
+                        help='output format')
+    parser.add_argument('-sm', '--sample_method', type=str, default='ddim',
+                        choices=['ddpm', 'ddim', 'dpmpp_2m', 'dpmpp_3m', 'unipc', 'heun'],
+                        help='Diffusion sampler.')
+    parser.add_argument('-st', '--sampling_timesteps', type=int, default=None,
+                        help='Number of sampling steps, defaults to the one stored in the model.')
+    parser.add_argument('--feature_cache', type=str, default="inference/feature_cache",
+                        help='Feature cache folder shared by the workers. An empty string turns it off.')
+    parser.add_argument('--feature_cache_gb', type=float, default=2,
+                        help='Size of the feature cache.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    jobs = find_jobs(args)
+    todo = [job for job in jobs if args.overwrite or not os.path.exists(output_path(args, job))]
+    print(f'{len(jobs)} jobs, {len(jobs) - len(todo)} done already')
+    if not todo:
+        return
+    # longest first, so no worker is left with a long file while the others are idle
+    durations = {source: duration(os.path.join(args.input_dir, source)) for source in {job[0] for job in todo}}
+    todo.sort(key=lambda job: durations[job[0]], reverse=True)
+
+    start = time.time()
+    converted, failed = 0., []
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('i', 0)
+    with context.Pool(args.workers, initializer=init_worker, initargs=(args, counter)) as pool:
+        for n, (job, seconds, use_time, error) in enumerate(pool.imap_unordered(convert, todo, chunksize=1), 1):
+            if error is None:
+                converted += seconds
+                print(f'[{n}/{len(todo)}] {job[0]} -> {output_path(args, job)}, {seconds:.1f}s audio in {use_time:.1f}s')
+            else:
+                failed.append(job)
+                print(f'[{n}/{len(todo)}] {job[0]} failed: {error}')
+    total = time.time() - start
+    print(f'converted {len(todo) - len(failed)} jobs, {converted:.1f}s of audio in {total:.1f}s, {converted / total:.2f}x real time')
+    if failed:
+        print(f'{len(failed)} failed, run again to retry: ' + ', '.join(source for source, _, _ in failed))
+
+
+if __name__ == '__main__':
+    main()
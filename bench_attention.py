@@ -0,0 +1,66 @@
+import json
+import multiprocessing
+import resource
+import time
+
+import torch
+
+from model import PhoneEncoder
+
+
+def run(cfg, frames, window, device, repeat):
+    # one encoder forward, returns the peak memory it added in MB and the time per forward
+    torch.manual_seed(0)
+    device = torch.device(device)
+    encoder = PhoneEncoder(**{**cfg, 'attention_window': window}).to(device).eval()
+    x = torch.randn(1, cfg['in_channels'], frames, device=device)
+    lengths = torch.LongTensor([frames]).to(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.max_memory_allocated()
+    else:
+        # ru_maxrss is the peak of the whole process in KB, hence a fresh process per run
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with torch.no_grad():
+        start = time.time()
+        for _ in range(repeat):
+            encoder(x, lengths)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        use_time = (time.time() - start) / repeat
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return (peak - base) / 2 ** 20, use_time
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='peak memory and time of the phoneme encoder, full against windowed self attention')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file, the phoneme_encoder section is benchmarked.')
+    parser.add_argument('-d', '--device', type=str, default='cpu',
+                        help='Device to benchmark on.')
+    parser.add_argument('-l', '--lengths', type=int, nargs='+', default=[512, 1024, 2048, 4096, 8192],
+                        help='Frame counts to benchmark.')
+    parser.add_argument('-w', '--windows', type=int, nargs='+', default=[0, 64, 128],
+                        help='Attention windows, 0 is full attention.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timed forwards per run.')
+    args = parser.parse_args()
+
+    cfg = json.load(open(args.config_path))['phoneme_encoder']
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{"frames":>8}{"window":>8}{"peak(MB)":>10}{"time(ms)":>10}')
+    for frames in args.lengths:
+        for window in args.windows:
+            with ctx.Pool(1) as pool:
+                peak, use_time = pool.apply(run, (cfg, frames, window or None, args.device, args.repeat))
+            print(f'{frames:>8}{window or "full":>8}{peak:>10.1f}{use_time * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
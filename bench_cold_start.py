@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+MARKER = "cold start: "
+
+
+def child(args):
+    # one cold start, absolute timestamps so the parent can put the interpreter start in front
+    from inference.infer_tool import Svc
+    imported = time.time()
+    svc = Svc(args.model_path[0], args.config_path, args.device, lazy=args.lazy)
+    built = time.time()
+    audio = svc.slice_inference(args.source, svc.load_audio(args.refer), 0, args.slice_db, args.auto_predict_f0,
+                                sampling_timesteps=args.sampling_timesteps)
+    done = time.time()
+    print(MARKER + json.dumps({
+        "imported": imported,
+        "built": built,
+        "done": done,
+        "audio": len(audio) / svc.target_sample,
+        "load_times": svc.load_times,
+        # kilobytes on linux
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+    # the interpreter teardown is not part of the cold start
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def run(args, model_path, lazy):
+    command = [sys.executable, __file__, "--child", "-m", model_path, "-c", args.config_path, "-s", args.source,
+               "-r", args.refer, "-sd", str(args.slice_db), "-d", args.device]
+    if args.sampling_timesteps:
+        command += ["-st", str(args.sampling_timesteps)]
+    if args.auto_predict_f0:
+        command.append("-a")
+    if lazy:
+        command.append("--lazy")
+    start = time.time()
+    output = subprocess.run(command, capture_output=True, text=True)
+    if output.returncode:
+        raise RuntimeError(output.stderr)
+    line = [line for line in output.stdout.splitlines() if line.startswith(MARKER)][-1]
+    result = json.loads(line[len(MARKER):])
+    return {
+        "startup": result["imported"] - start,
+        "init": result["built"] - result["imported"],
+        "first output": result["done"] - start,
+        "model": result["load_times"].get("model", 0.),
+        "max_rss": result["max_rss"] / 1024,
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='seconds from starting the interpreter to the first converted file, per model file, eager against lazy loading')
+    parser.add_argument('-m', '--model_path', type=str, nargs='+', default=["logs/model-127.pt"],
+                        help='Training checkpoints and exports of export_inference.py to compare.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-s', '--source', type=str, default="raw/1.wav",
+                        help='Audio converted by every run, keep it short.')
+    parser.add_argument('-r', '--refer', type=str, default="raw/1.wav",
+                        help='Reference audio.')
+    parser.add_argument('-d', '--device', type=str, default='cpu',
+                        help='Device to benchmark on.')
+    parser.add_argument('-st', '--sampling_timesteps', type=int, default=None,
+                        help='Number of sampling steps, defaults to the one stored in the model.')
+    parser.add_argument('-a', '--auto_predict_f0', action='store_true', default=False,
+                        help='Automatic pitch prediction.')
+    parser.add_argument('-sd', '--slice_db', type=int, default=-40,
+                        help='Loudness for automatic slicing.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per setting, the median is reported. Only the first one reads the files from disk.')
+    parser.add_argument('--lazy', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    columns = ["startup", "init", "model", "first output", "max_rss"]
+    print(f"{'model':<40} {'loading':<8} " + " ".join(f"{column:>13}" for column in columns))
+    for model_path in args.model_path:
+        for lazy in (False, True):
+            runs = [run(args, model_path, lazy) for _ in range(args.repeat)]
+            median = {column: statistics.median(r[column] for r in runs) for column in columns}
+            print(f"{model_path:<40} {'lazy' if lazy else 'eager':<8} "
+                  + " ".join(f"{median[column]:>12.1f}M" if column == "max_rss" else f"{median[column]:>12.3f}s" for column in columns))
+
+
+if __name__ == '__main__':
+    main()
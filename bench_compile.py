@@ -0,0 +1,70 @@
+import json
+import logging
+import time
+
+import torch
+
+from inference.infer_tool import BUCKETS, load_mod
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='per step latency of the denoiser, torch.compile against eager, for every bucket')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-d', '--device', type=str, default='cpu',
+                        help='Device to benchmark on.')
+    parser.add_argument('-b', '--buckets', type=int, nargs='+', default=BUCKETS,
+                        help='Frame counts to benchmark.')
+    parser.add_argument('--refer_frames', type=int, default=512,
+                        help='Reference length, the step only sees the 32 resampled prompt latents.')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Timed steps per bucket.')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    cfg = json.load(open(args.config_path))
+    model, _ = load_mod(args.model_path, device, cfg)
+    model.freeze_for_inference()
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(args.buckets))
+    compiled_step = torch.compile(model.diff_model.forward_step, dynamic=False)
+
+    def timed(step, x, cond, t):
+        step(x, cond, t)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.repeat):
+            step(x, cond, t)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return (time.time() - start) / args.repeat
+
+    print(f'{"frames":>8}{"eager(ms)":>12}{"compiled(ms)":>14}{"compile(s)":>12}{"speedup":>9}')
+    for frames in args.buckets:
+        c = torch.randn(1, 256, frames, device=device)
+        refer = torch.randn(1, 100, args.refer_frames, device=device)
+        f0 = torch.rand(1, frames, device=device) * 200 + 100
+        uv = torch.ones(1, frames, device=device)
+        lengths = torch.LongTensor([frames]).to(device)
+        refer_lengths = torch.LongTensor([args.refer_frames]).to(device)
+        x = torch.randn(1, model.dim, frames, device=device)
+        t = torch.LongTensor([500]).to(device)
+        with torch.no_grad():
+            content, audio_prompt = model.pre_model.infer((c, refer, f0, 0, 0, lengths, refer_lengths, uv))
+            cond = model.diff_model.encode_cond((content, audio_prompt, lengths, refer_lengths))
+            eager = timed(model.diff_model.forward_step, x, cond, t)
+            start = time.time()
+            compiled_step(x, cond, t)
+            compile_time = time.time() - start
+            compiled = timed(compiled_step, x, cond, t)
+        print(f'{frames:>8}{eager * 1000:>12.2f}{compiled * 1000:>14.2f}{compile_time:>12.1f}{eager / compiled:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import copy
+import logging
+import time
+
+import torch
+
+import quantize
+from inference.infer_tool import Svc
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='compare int8 inference against fp32 on cpu')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-s', '--source', type=str, default="raw/2.wav",
+                        help='Source audio path.')
+    parser.add_argument('-r', '--refer', type=str, default="raw/1.wav",
+                        help='Reference audio path.')
+    parser.add_argument('-t', '--trans', type=int, default=0,
+                        help='Pitch adjustment in semitones.')
+    parser.add_argument('-sm', '--sample_method', type=str, default='dpmpp_2m',
+                        help='Diffusion sampler.')
+    parser.add_argument('-st', '--sampling_timesteps', type=int, default=20,
+                        help='Number of sampling steps.')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch cpu threads, None keeps the torch default.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timed runs per mode, the fastest one is reported.')
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='Seed shared by every run, so all modes start from the same noise.')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    svc_model = Svc(args.model_path, args.config_path, 'cpu')
+    c, refer, f0, uv, lengths, refer_lengths = svc_model.get_unit_f0_code(args.source, args.trans, args.refer, False, False)
+    seconds = c.shape[-1] * svc_model.hop_size / svc_model.target_sample
+
+    def run(model):
+        # f0 scale and noise both come from the seeded generator
+        use_time = float('inf')
+        for _ in range(args.repeat):
+            torch.manual_seed(args.seed)
+            start = time.time()
+            with torch.no_grad():
+                mel = model.sample(c, refer, f0, uv, lengths, refer_lengths, None, auto_predict_f0=True,
+                                   sampling_timesteps=args.sampling_timesteps, sample_method=args.sample_method)
+            use_time = min(use_time, time.time() - start)
+        return mel, use_time
+
+    # dynamic quantization needs no calibration data, the activation ranges are measured on every call
+    reference, reference_time = run(svc_model.model)
+    print(f'{seconds:.2f}s of audio, {args.sample_method} {args.sampling_timesteps} steps, {torch.get_num_threads()} threads')
+    print(f'{"mode":<10}{"rtf":>8}{"speedup":>9}{"mel l1":>10}')
+    print(f'{"fp32":<10}{reference_time / seconds:>8.3f}{1:>8.1f}x{0:>10.4f}')
+    for mode in quantize.QUANTIZE_MODES:
+        model = quantize.quantize(copy.deepcopy(svc_model.model), mode)
+        mel, use_time = run(model)
+        l1 = (mel - reference).abs().mean().item()
+        print(f'{mode:<10}{use_time / seconds:>8.3f}{reference_time / use_time:>8.1f}x{l1:>10.4f}')
+
+
+if __name__ == '__main__':
+    main()
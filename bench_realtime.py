@@ -0,0 +1,86 @@
+import logging
+import time
+
+import librosa
+import numpy as np
+import soundfile
+
+from inference.infer_tool import Svc
+from inference.streaming import StreamingVC
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='latency of streaming conversion, the source is pushed as a simulated input stream')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-s', '--source', type=str, default="raw/2.wav",
+                        help='Source audio path, streamed at the model sample rate.')
+    parser.add_argument('-r', '--refer', type=str, default="raw/1.wav",
+                        help='Reference audio path.')
+    parser.add_argument('-t', '--trans', type=int, default=0,
+                        help='Pitch adjustment in semitones.')
+    parser.add_argument('-d', '--device', type=str, default=None,
+                        help='Device used for inference. None means auto selecting.')
+    parser.add_argument('-sm', '--sample_method', type=str, default='dpmpp_2m',
+                        help='Diffusion sampler.')
+    parser.add_argument('-st', '--sampling_timesteps', type=int, default=10,
+                        help='Number of sampling steps.')
+    parser.add_argument('--block', type=float, default=0.5,
+                        help='Seconds converted per block.')
+    parser.add_argument('--context', type=float, default=1.0,
+                        help='Seconds of past input converted with every block.')
+    parser.add_argument('--lookahead', type=float, default=0.1,
+                        help='Seconds of future input converted with every block.')
+    parser.add_argument('--crossfade', type=float, default=0.05,
+                        help='Seconds overlap-added between blocks, at most the lookahead.')
+    parser.add_argument('--callback_ms', type=float, default=10,
+                        help='Size of the simulated audio callback in milliseconds.')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Write the streamed conversion to this wav file.')
+    args = parser.parse_args()
+
+    svc_model = Svc(args.model_path, args.config_path, args.device)
+    stream = StreamingVC(svc_model, args.refer, args.trans,
+                         block_seconds=args.block,
+                         context_seconds=args.context,
+                         lookahead_seconds=args.lookahead,
+                         crossfade_seconds=args.crossfade,
+                         sample_method=args.sample_method,
+                         sampling_timesteps=args.sampling_timesteps)
+    sr = svc_model.target_sample
+    wav, _ = librosa.load(args.source, sr=sr)
+    callback = int(args.callback_ms / 1000 * sr)
+
+    # the first block also loads lazily initialized kernels, it is converted and dropped
+    stream.push(np.zeros(stream.window, dtype=np.float32))
+    stream.flush()
+
+    out = []
+    start = time.time()
+    for i in range(0, len(wav), callback):
+        stream.push(wav[i:i + callback])
+        out.append(stream.pull())
+    times = np.array(stream.block_times)
+    out.append(stream.flush())
+    total = time.time() - start
+    out = np.concatenate(out)
+
+    block = stream.block / sr
+    print(f'{len(wav) / sr:.2f}s of audio, {args.sample_method} {args.sampling_timesteps} steps, {len(times)} blocks of {block * 1000:.0f}ms')
+    print(f'algorithmic latency  {stream.latency * 1000:8.1f}ms  (block {block * 1000:.0f}ms + lookahead {stream.lookahead / sr * 1000:.0f}ms)')
+    print(f'compute per block    {times.mean() * 1000:8.1f}ms  mean, {np.percentile(times, 95) * 1000:.1f}ms p95, {times.max() * 1000:.1f}ms max')
+    print(f'total latency        {(stream.latency + np.percentile(times, 95)) * 1000:8.1f}ms  (algorithmic + p95 compute)')
+    print(f'real time factor     {times.mean() / block:8.3f}   ({total:.2f}s wall for the whole stream)')
+    print(f'late blocks          {int((times > block).sum()):8d}   (compute longer than a block, playback would underrun)')
+    if args.output:
+        soundfile.write(args.output, out, sr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import logging
+import time
+
+import torch
+
+from inference.infer_tool import Svc
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='compare fast samplers against the 200 step ddim output')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-s', '--source', type=str, default="raw/2.wav",
+                        help='Source audio path.')
+    parser.add_argument('-r', '--refer', type=str, default="raw/1.wav",
+                        help='Reference audio path.')
+    parser.add_argument('-t', '--trans', type=int, default=0,
+                        help='Pitch adjustment in semitones.')
+    parser.add_argument('-d', '--device', type=str, default=None,
+                        help='Device used for inference. None means auto selecting.')
+    parser.add_argument('-sm', '--sample_methods', type=str, nargs='+',
+                        default=['ddim', 'dpmpp_2m', 'dpmpp_3m', 'unipc', 'heun'],
+                        help='Samplers to compare.')
+    parser.add_argument('-st', '--steps', type=int, nargs='+', default=[10, 15, 20, 25],
+                        help='Step counts to compare.')
+    parser.add_argument('--reference_steps', type=int, default=200,
+                        help='Step count of the ddim reference.')
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='Seed shared by every run, so all samplers start from the same noise.')
+    args = parser.parse_args()
+
+    svc_model = Svc(args.model_path, args.config_path, args.device)
+    c, refer, f0, uv, lengths, refer_lengths = svc_model.get_unit_f0_code(args.source, args.trans, args.refer, False, False)
+
+    def run(sample_method, sampling_timesteps):
+        torch.manual_seed(args.seed)
+        start = time.time()
+        mel = svc_model.model.sample(c, refer, f0, uv, lengths, refer_lengths, None,
+                                     auto_predict_f0=True, sampling_timesteps=sampling_timesteps, sample_method=sample_method)
+        if mel.is_cuda:
+            torch.cuda.synchronize()
+        return mel, time.time() - start
+
+    reference, reference_time = run('ddim', args.reference_steps)
+    print(f'ddim {args.reference_steps} steps: {reference_time:.3f}s, {reference.shape[-1]} frames')
+    print(f'{"method":<10}{"steps":>6}{"mel l1":>10}{"time(s)":>10}{"speedup":>9}')
+    for sample_method in args.sample_methods:
+        for steps in args.steps:
+            mel, use_time = run(sample_method, steps)
+            l1 = (mel - reference).abs().mean().item()
+            print(f'{sample_method:<10}{steps:>6}{l1:>10.4f}{use_time:>10.3f}{reference_time / use_time:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+async def request(args, method, path, payload=None):
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {args.host}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    response = await reader.read()
+    writer.close()
+    return status, response.split(b'\r\n\r\n', 1)[1]
+
+
+async def run(args):
+    latencies, failed = [], 0
+    pending = iter(range(args.requests))
+
+    async def client():
+        nonlocal failed
+        for i in pending:
+            payload = {'source': args.source[i % len(args.source)], 'refer': args.refer[i % len(args.refer)], 'tran': args.trans}
+            start = time.time()
+            status, _ = await request(args, 'POST', '/convert', payload)
+            if status == 200:
+                latencies.append(time.time() - start)
+            else:
+                failed += 1
+
+    start = time.time()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    total = time.time() - start
+    _, stats = await request(args, 'GET', '/stats')
+    return np.array(latencies), failed, total, json.loads(stats)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='load generator for server.py, throughput and latency at a fixed concurrency')
+    parser.add_argument('-s', '--source', type=str, nargs='+', default=["raw/2.wav"],
+                        help='Source audio paths as the server sees them, used round robin.')
+    parser.add_argument('-r', '--refer', type=str, nargs='+', default=["raw/1.wav"],
+                        help='Reference audio paths as the server sees them, used round robin.')
+    parser.add_argument('-t', '--trans', type=int, default=0,
+                        help='Pitch adjustment in semitones.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Server address.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Server port.')
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Server unix socket, instead of host and port.')
+    parser.add_argument('-n', '--requests', type=int, default=64,
+                        help='Requests in total.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Requests in flight at any time.')
+    args = parser.parse_args()
+
+    latencies, failed, total, stats = asyncio.run(run(args))
+    print(f'{len(latencies)} requests ok, {failed} failed, concurrency {args.concurrency}')
+    print(f'throughput  {len(latencies) / total:8.2f} req/s')
+    if len(latencies):
+        print(f'latency     {np.percentile(latencies, 50) * 1000:8.1f}ms p50, {np.percentile(latencies, 99) * 1000:.1f}ms p99')
+    print(f'batches     {stats["batches"]:8d}, mean size {stats["mean_batch_size"]:.2f}, sizes {stats["batch_sizes"]}')
+    print(f'queue depth {stats["max_queue_depth"]:8d} max')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import wave
+
+import numpy as np
+import soundfile
+
+from inference.infer_tool import OutputAssembler
+
+SAMPLE_RATE = 24000
+SEGMENT = 4800
+MARKER = "written: "
+
+
+def segment(k):
+    return np.full(SEGMENT, (k % 20 - 10) / 20, dtype=np.float32)
+
+
+def child(path, wav_format):
+    # streams segments forever, reporting the samples written after each one
+    plan = [(False, None, SEGMENT, False)] * 10 ** 6
+    with soundfile.SoundFile(path, 'w', SAMPLE_RATE, 1, format=wav_format) as sink:
+        audio = OutputAssembler(plan, SAMPLE_RATE, sink=sink)
+        for k in range(len(plan)):
+            audio.add(segment(k), SEGMENT)
+            print(MARKER + str(audio.offset), flush=True)
+
+
+def check(wav_format, segments):
+    # kill the writer after some segments, the file has to read back as everything reported written
+    path = os.path.join(tempfile.mkdtemp(), f"stream.{wav_format}")
+    writer = subprocess.Popen([sys.executable, __file__, "--child", path, wav_format], stdout=subprocess.PIPE, text=True)
+    reports = 0
+    while reports < segments:
+        line = writer.stdout.readline()
+        if line.startswith(MARKER):
+            written = int(line[len(MARKER):])
+            reports += 1
+    writer.send_signal(signal.SIGKILL)
+    writer.wait()
+    audio, sr = soundfile.read(path, dtype='float32')
+    expected = np.concatenate([segment(k) for k in range(written // SEGMENT)])
+    assert sr == SAMPLE_RATE
+    assert len(audio) >= written, f"{wav_format}: {len(audio)} samples readable, {written} were written"
+    assert np.abs(audio[:written] - expected).max() < 1e-3, f"{wav_format}: readable samples differ"
+    if wav_format == 'wav':
+        # libsndfile falls back to the file size, stricter readers take the length in the header
+        with wave.open(path) as f:
+            assert f.getnframes() >= written, f"wav header: {f.getnframes()} samples, {written} were written"
+    print(f"{wav_format}: killed after {written} samples, {len(audio)} read back")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='kill a streaming writer of infer.py -so mid-run and read the file back')
+    parser.add_argument('-f', '--formats', type=str, nargs='+', default=['wav'],
+                        help='Output formats to check. flac and ogg only get their length when the file is closed.')
+    parser.add_argument('-n', '--segments', type=int, default=20,
+                        help='Segments written before the kill.')
+    parser.add_argument('--child', type=str, nargs=2, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+    for wav_format in args.formats:
+        check(wav_format, args.segments)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+
+import numpy as np
+import soundfile
+
+from inference import slicer
+from inference.infer_tool import plan_segments, stream_plan
+
+
+def synth(sr, seed):
+    # speech-like bursts between silences of every length the slicer treats differently, sometimes with leading or trailing silence
+    rng = np.random.default_rng(seed)
+    parts = []
+    if seed % 2:
+        parts.append(rng.standard_normal(int(sr * rng.uniform(0, 12))) * 1e-4)
+    for _ in range(rng.integers(1, 25)):
+        n = int(sr * rng.uniform(0.05, 8))
+        parts.append(rng.standard_normal(n) * 0.2 * np.abs(np.sin(np.arange(n) / sr * rng.uniform(1, 6))))
+        silence = rng.choice([rng.uniform(0, .5), rng.uniform(0.2, 4), rng.uniform(4, 15)])
+        parts.append(rng.standard_normal(int(sr * silence)) * 10 ** rng.uniform(-5, -2.5))
+    if seed % 3 == 0:
+        parts.pop()
+    return np.concatenate(parts).astype(np.float32)
+
+
+def check_slicer(sr, seed, db_thresh):
+    # same ranges as Slicer.slice, pushed in random block sizes
+    audio = synth(sr, seed)
+    expected = slicer.Slicer(sr, db_thresh).slice(audio)
+    stream = slicer.StreamingSlicer(sr, db_thresh)
+    rng = np.random.default_rng(seed)
+    segments, pos = [], 0
+    while pos < len(audio):
+        size = int(rng.integers(1, sr))
+        segments += stream.push(audio[pos:pos + size])
+        pos += size
+    segments += stream.flush()
+    ranges = np.array([[begin, end, silent] for begin, end, silent, _ in segments], dtype=np.int64).reshape(-1, 3)
+    assert np.array_equal(ranges, expected), f"sr {sr} seed {seed} {db_thresh}dB: {ranges.tolist()} != {expected.tolist()}"
+    assert all(np.array_equal(samples, audio[begin:end]) for begin, end, _, samples in segments), "samples differ"
+    return len(ranges)
+
+
+def check_plan(sr, seed, clip_seconds, lg_num):
+    # infer.py -so reads the file through stream_plan, the plan has to match the one of the whole decoded file
+    audio = synth(sr, seed)
+    path = os.path.join(tempfile.mkdtemp(), "source.wav")
+    soundfile.write(path, audio, sr, subtype='FLOAT')
+    expected = plan_segments(slicer.split(audio, slicer.cut_audio(audio, sr, db_thresh=-40)), sr, 24000, clip_seconds, lg_num)
+    plan = list(stream_plan(path, 24000, -40, clip_seconds=clip_seconds, lg_num=lg_num, block_seconds=1.3))
+    assert len(plan) == len(expected), f"sr {sr} seed {seed}: {len(plan)} segments, {len(expected)} expected"
+    for (tag, dat, length, crossfade), (e_tag, e_dat, e_length, e_crossfade) in zip(plan, expected):
+        assert (tag, length, crossfade) == (e_tag, e_length, e_crossfade) and np.array_equal(dat, e_dat), f"sr {sr} seed {seed}"
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='StreamingSlicer against Slicer.slice on synthetic audio pushed in random block sizes')
+    parser.add_argument('-n', '--cases', type=int, default=60,
+                        help='Synthetic sources.')
+    args = parser.parse_args()
+
+    ranges = 0
+    for seed in range(args.cases):
+        sr = [16000, 22050, 24000, 44100, 48000][seed % 5]
+        for db_thresh in (-40, -30):
+            ranges += check_slicer(sr, seed, db_thresh)
+    print(f"slicer: {2 * args.cases} cases, {ranges} ranges, all equal")
+    for seed in range(min(args.cases, 10)):
+        check_plan([16000, 44100][seed % 2], seed, clip_seconds=[0, 2][seed % 2], lg_num=[0, 0.5][seed % 2])
+    print(f"stream_plan: {min(args.cases, 10)} files, all equal")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+from model import Trainer
+
+trainer = Trainer()
+trainer.distill(trainer.cfg['distill']['teacher_path'])
@@ -0,0 +1,48 @@
+import json
+import logging
+import os
+
+import torch
+
+from inference.infer_tool import INFERENCE_FORMAT, load_mod
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='write the ema weights of a training checkpoint as an inference only checkpoint, infer.py and Svc take it in place of the model')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file, stored in the export.')
+    parser.add_argument('-o', '--out_path', type=str, default=None,
+                        help='Output file, defaults to the model path without suffix plus _infer.pt.')
+    parser.add_argument('--fp16', action='store_true', default=False,
+                        help='Store the weights in half precision, they are cast back to float32 on load.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    out_path = args.out_path or os.path.splitext(args.model_path)[0] + "_infer.pt"
+    cfg = json.load(open(args.config_path))
+    model, sampling_timesteps = load_mod(args.model_path, "cpu", cfg)
+    # weight norm baked in, so loading skips it as well
+    model.freeze_for_inference()
+    params = {name for name, _ in model.named_parameters()}
+    # only the weights go to half, the diffusion schedule buffers keep their precision
+    state_dict = {name: tensor.half() if args.fp16 and name in params else tensor.contiguous()
+                  for name, tensor in model.state_dict().items()}
+    # torch's zip format keeps every tensor as an aligned uncompressed record, load_mod maps them with mmap=True
+    torch.save({
+        'format': INFERENCE_FORMAT,
+        'cfg': cfg,
+        'model': state_dict,
+        'sampling_timesteps': sampling_timesteps,
+    }, out_path)
+    print(f"exported {args.model_path} ({os.path.getsize(args.model_path) / 1024 ** 2:.1f} MB) "
+          f"to {out_path} ({os.path.getsize(out_path) / 1024 ** 2:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import json
+import logging
+import os
+
+from inference import onnx_backend
+from inference.infer_tool import load_mod
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='export the ema model to onnx, run it with infer.py -b onnx')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-o', '--out_dir', type=str, default=None,
+                        help='Output folder, defaults to the model path without suffix plus _onnx.')
+    parser.add_argument('--opset', type=int, default=17,
+                        help='ONNX opset version.')
+    parser.add_argument('--atol', type=float, default=1e-3,
+                        help='Largest absolute difference to the torch model accepted by the check after export.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    out_dir = args.out_dir or os.path.splitext(args.model_path)[0] + "_onnx"
+    cfg = json.load(open(args.config_path))
+    model, _ = load_mod(args.model_path, "cpu", cfg)
+    model.freeze_for_inference()
+    onnx_backend.export_onnx(model, out_dir, opset_version=args.opset)
+    pre_model, diff_model = onnx_backend.load_onnx(out_dir)
+    onnx_backend.check_onnx(model, pre_model, diff_model, atol=args.atol)
+    print(f"exported {onnx_backend.PROMPT}, {onnx_backend.PRE_MODEL}, {onnx_backend.DIFF_COND} and {onnx_backend.DIFF_STEP} to {out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
-import io
+import collections
 import logging
 import time
-from pathlib import Path
 
 import librosa
 import matplotlib.pyplot as plt
@@ -10,10 +9,10 @@ import soundfile
 
 from inference import infer_tool
 from inference import slicer
+from inference.pipeline import segment_pipeline
 from inference.infer_tool import Svc
 
 logging.getLogger('numba').setLevel(logging.WARNING)
-chunks_dict = infer_tool.read_temp("inference/chunks_temp.json")
 
 
 
@@ -33,6 +32,10 @@ def main():
                         help='A list of wav file names located in the raw folder.')
     parser.add_argument('-t', '--trans', type=int, nargs='+', default=[0],
                         help='Pitch adjustment, supports positive and negative (semitone) values.')
+    parser.add_argument('-spk', '--speakers', type=str, nargs='+', default=None,
+                        help='Speakers of the speaker library, used instead of the reference audio.')
+    parser.add_argument('-sl', '--speaker_library', type=str, default="logs/speakers",
+                        help='Speaker library written by make_speaker_library.py.')
 
     # Optional
     parser.add_argument('-a', '--auto_predict_f0', action='store_true', default=True,
@@ -57,6 +60,29 @@ def main():
                         help='Proportion of cross length retention, range (0-1]. After forced slicing, the beginning and end of each segment need to be discarded.')
     parser.add_argument('-ft', '--f0_filter_threshold', type=float, default=0.05,
                         help='F0 Filtering threshold: This parameter is valid only when f0_mean_pooling is enabled. Values range from 0 to 1. Reducing this value reduces the probability of being out of tune, but increases matte.')
+    parser.add_argument('-sm', '--sample_method', type=str, default='ddim',
+                        choices=['ddpm', 'ddim', 'dpmpp_2m', 'dpmpp_3m', 'unipc', 'heun'],
+                        help='Diffusion sampler. dpmpp_2m, dpmpp_3m and unipc give good results with 10-25 steps, heun uses two model evaluations per step.')
+    parser.add_argument('-st', '--sampling_timesteps', type=int, default=None,
+                        help='Number of sampling steps, ignored by ddpm. None uses the step count recorded in the checkpoint, 200 unless it was distilled.')
+    parser.add_argument('-fo', '--fan_out', action='store_true', default=False,
+                        help='Extract the source features once and convert every refer_names x trans combination in one batched sampling run. In this mode every trans value is applied to every clean file.')
+    parser.add_argument('-b', '--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                        help='Run the model in PyTorch or with onnxruntime on the graphs written by export_onnx.py.')
+    parser.add_argument('--onnx_dir', type=str, default=None,
+                        help='Folder of the exported graphs, defaults to the model path without suffix plus _onnx.')
+    parser.add_argument('-q', '--quantize', type=str, default=None, choices=['dynamic', 'weight'],
+                        help='int8 inference on cpu with the torch backend. dynamic quantizes weights and activations, weight only the weights.')
+    parser.add_argument('--feature_cache', type=str, default="inference/feature_cache",
+                        help='Folder caching slicing, contentvec and f0 of the sources by audio content. An empty string turns it off.')
+    parser.add_argument('--feature_cache_gb', type=float, default=2,
+                        help='Size of the feature cache, the least recently used entries are removed beyond it.')
+    parser.add_argument('-so', '--stream_output', action='store_true', default=False,
+                        help='Write every converted segment to the output file as soon as it is done instead of keeping the whole file in memory. The source is read in blocks and sliced as it arrives, so it has to be a format soundfile reads. With wav output an interrupted run leaves a playable file up to the last segment.')
+    parser.add_argument('--pipeline_queue', type=int, default=2,
+                        help='Segments waiting between the feature extraction, sampling and vocoder stages, which run concurrently.')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile the denoiser step. Inputs are padded to a fixed set of frame counts, which are all compiled at startup.')
 
 
     args = parser.parse_args()
@@ -66,6 +92,7 @@ def main():
     trans = args.trans
     slice_db = args.slice_db
     wav_format = args.wav_format
+    stream_output = args.stream_output
     auto_predict_f0 = args.auto_predict_f0
     pad_seconds = args.pad_seconds
     clip = args.clip
@@ -73,81 +100,96 @@ def main():
     lgr = args.linear_gradient_retain
     F0_mean_pooling = args.f0_mean_pooling
     cr_threshold = args.f0_filter_threshold
-
-    svc_model = Svc(args.model_path, args.config_path, args.device)
+    fan_out = args.fan_out
+    sample_method = args.sample_method
+    sampling_timesteps = args.sampling_timesteps
+    speakers = args.speakers
+    assert not (speakers and fan_out), "fan-out mode takes reference audio, not speakers"
+
+    svc_model = Svc(args.model_path, args.config_path, args.device, backend=args.backend, onnx_dir=args.onnx_dir, quantize=args.quantize,
+                    compile=args.compile, batch_sizes=[len(refer_names) * len(trans)] if fan_out else [1],
+                    speaker_library=args.speaker_library if speakers else None,
+                    feature_cache=args.feature_cache, feature_cache_bytes=int(args.feature_cache_gb * 1024 ** 3))
     raw_folder = "raw"
     results_folder = "output"
     infer_tool.mkdir([raw_folder, results_folder])
 
-    infer_tool.fill_a_to_b(trans, clean_names)
-    for clean_name, tran in zip(clean_names, trans):
+    if not fan_out:
+        infer_tool.fill_a_to_b(trans, clean_names)
+    for i, clean_name in enumerate(clean_names):
         raw_audio_path = f"{raw_folder}/{clean_name}"
         if "." not in raw_audio_path:
             raw_audio_path += ".wav"
-        infer_tool.format_wav(raw_audio_path)
-        wav_path = Path(raw_audio_path).with_suffix('.wav')
-        chunks = slicer.cut(wav_path, db_thresh=slice_db)
-        audio_data, audio_sr = slicer.chunks2audio(wav_path, chunks)
-        per_size = int(clip*audio_sr)
-        lg_size = int(lg*audio_sr)
-        lg_size_r = int(lg_size*lgr)
-        lg_size_c_l = (lg_size-lg_size_r)//2
-        lg_size_c_r = lg_size-lg_size_r-lg_size_c_l
-        lg = np.linspace(0,1,lg_size_r) if lg_size!=0 else 0
-
-        for refer_name in refer_names:
-            audio = []
+        if stream_output:
+            # read block by block and sliced as it comes, by every group again
+            audio_sr = soundfile.info(raw_audio_path).samplerate
+            plan = None
+        else:
+            # decoded once, every slice below is a view of this buffer
+            source, audio_sr = slicer.load(raw_audio_path)
+            chunks = svc_model.cut(source, audio_sr, db_thresh=slice_db)
+            audio_data = slicer.split(source, chunks)
+            plan = infer_tool.plan_segments(audio_data, audio_sr, svc_model.target_sample, clip, lg)
+
+        # decoded by get_refer, whatever the format
+        refer_paths = []
+        for refer_name in refer_names if not speakers else []:
             refer_path = f"{raw_folder}/{refer_name}"
             if "." not in refer_path:
                 refer_path += ".wav"
-            infer_tool.format_wav(refer_path)
-            refer_path = Path(refer_path).with_suffix('.wav')
-            for (slice_tag, data) in audio_data:
-                print(f'#=====segment start, {round(len(data) / audio_sr, 3)}s======')
-                
-                length = int(np.ceil(len(data) / audio_sr * svc_model.target_sample))
-                if slice_tag:
-                    print('jump empty segment')
-                    _audio = np.zeros(length)
-                    audio.extend(list(infer_tool.pad_array(_audio, length)))
-                    continue
-                if per_size != 0:
-                    datas = infer_tool.split_list_by_n(data, per_size,lg_size)
+            refer_paths.append(refer_path)
+        # every variant of a group shares one sampling run in fan-out mode
+        if fan_out:
+            groups = [[(refer_name, refer_path, tran) for refer_name, refer_path in zip(refer_names, refer_paths) for tran in trans]]
+        elif speakers:
+            groups = [[(speaker, None, trans[i])] for speaker in speakers]
+        else:
+            groups = [[(refer_name, refer_path, trans[i])] for refer_name, refer_path in zip(refer_names, refer_paths)]
+
+        for group in groups:
+            res_paths = []
+            for refer_name, _, tran in group:
+                key = "auto" if auto_predict_f0 else f"{tran}key"
+                res_paths.append(f'./{results_folder}/{clean_name}_{key}_{refer_name}.{wav_format}')
+            sinks = [soundfile.SoundFile(res_path, 'w', svc_model.target_sample, 1, format=wav_format) if stream_output else None
+                     for res_path in res_paths]
+            audios = [infer_tool.OutputAssembler(plan, svc_model.target_sample, lg, lgr, sink=sink) for sink in sinks]
+            if speakers:
+                variants = [(*svc_model.get_speaker(refer_name), tran) for refer_name, _, tran in group]
+            else:
+                variants = [(svc_model.get_refer(refer_path), None, tran) for _, refer_path, tran in group]
+            pipeline = segment_pipeline(svc_model, variants, audio_sr,
+                                        pad_seconds = pad_seconds,
+                                        auto_predict_f0 = auto_predict_f0,
+                                        F0_mean_pooling = F0_mean_pooling,
+                                        cr_threshold = cr_threshold,
+                                        sample_method = sample_method,
+                                        sampling_timesteps = sampling_timesteps,
+                                        queue_size = args.pipeline_queue
+                                        )
+            # the entries the results belong to, in the order the pipeline returns them
+            entries = collections.deque()
+
+            def planned(entries_in):
+                for entry in entries_in:
+                    entries.append(entry)
+                    yield entry
+
+            segments = plan if plan is not None else infer_tool.stream_plan(raw_audio_path, svc_model.target_sample, slice_db,
+                                                                            clip_seconds=clip, lg_num=lg)
+            for out_audios in pipeline.run(planned(segments)):
+                slice_tag, dat, length, crossfade = entries.popleft()
+                for j, audio in enumerate(audios):
+                    if out_audios is None:
+                        audio.silence(length)
+                    else:
+                        audio.add(out_audios[j], length, crossfade)
+            pipeline.report()
+            for res_path, audio in zip(res_paths, audios):
+                if stream_output:
+                    audio.close()
                 else:
-                    datas = [data]
-                # print(len(datas))
-                for k,dat in enumerate(datas):
-                    per_length = int(np.ceil(len(dat) / audio_sr * svc_model.target_sample)) if clip!=0 else length
-                    if clip!=0: print(f'###=====segment clip start, {round(len(dat) / audio_sr, 3)}s======')
-                    # padd
-                    pad_len = int(audio_sr * pad_seconds)
-                    dat = np.concatenate([np.zeros([pad_len]), dat, np.zeros([pad_len])])
-                    raw_path = io.BytesIO()
-                    soundfile.write(raw_path, dat, audio_sr, format="wav")
-                    raw_path.seek(0)
-                    out_audio, out_sr = svc_model.infer(tran, raw_path, refer_path,
-                                                        auto_predict_f0=auto_predict_f0,
-                                                        F0_mean_pooling = F0_mean_pooling,
-                                                        cr_threshold = cr_threshold
-                                                        )
-                    # print(1)
-                    # print(out_audio.shape)
-                    _audio = out_audio.cpu().numpy()
-                    pad_len = int(svc_model.target_sample * pad_seconds)
-                    _audio = _audio[pad_len:-pad_len]
-                    _audio = infer_tool.pad_array(_audio, per_length)
-                    if lg_size!=0 and k!=0:
-                        lg1 = audio[-(lg_size_r+lg_size_c_r):-lg_size_c_r] if lgr != 1 else audio[-lg_size:]
-                        lg2 = _audio[lg_size_c_l:lg_size_c_l+lg_size_r]  if lgr != 1 else _audio[0:lg_size]
-                        lg_pre = lg1*(1-lg)+lg2*lg
-                        audio = audio[0:-(lg_size_r+lg_size_c_r)] if lgr != 1 else audio[0:-lg_size]
-                        audio.extend(lg_pre)
-                        _audio = _audio[lg_size_c_l+lg_size_r:] if lgr != 1 else _audio[lg_size:]
-                    audio.extend(list(_audio))
-                    # print(1)
-            key = "auto" if auto_predict_f0 else f"{tran}key"
-            res_path = f'./{results_folder}/{clean_name}_{key}_{refer_name}.{wav_format}'
-            soundfile.write(res_path, audio, svc_model.target_sample, format=wav_format)
+                    soundfile.write(res_path, audio.audio, svc_model.target_sample, format=wav_format)
             svc_model.clear_empty()
             
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+class FeatureCache:
+    # content addressed cache of extracted features, one .npz file per entry.
+    # reading an entry touches its mtime, when the folder grows past max_bytes the least recently used go first
+    def __init__(self, cache_dir="inference/feature_cache", max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = None
+
+    @staticmethod
+    def key(*parts):
+        # arrays by content, everything else by repr, so extraction parameters are part of the key
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(f"{part.dtype}{part.shape}".encode())
+                h.update(np.ascontiguousarray(part).tobytes())
+            elif isinstance(part, bytes):
+                h.update(part)
+            else:
+                h.update(repr(part).encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, evicted by another process or a partial file from a crash
+            return None
+        return arrays
+
+    def put(self, key, **arrays):
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        try:
+            # an entry written again replaces the old file
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.replace(tmp, path)
+        if self._size is None:
+            self._size = sum(entry.stat().st_size for entry in self._entries())
+        else:
+            self._size += os.path.getsize(path) - old_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npz")]
+
+    def evict(self):
+        # oldest mtime first, down to 90% of the budget so it does not run on every put
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if size <= 0.9 * self.max_bytes:
+                break
+            try:
+                size -= entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self._size = size
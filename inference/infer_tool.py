@@ -1,65 +1,55 @@
-import hashlib
-import io
 import json
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from inference import slicer
+from inference.feature_cache import FeatureCache
+from inference.pipeline import segment_pipeline
+from inference.speaker_library import SpeakerLibrary
+from inference.vocoder import Vocoder
 import gc
-from ema_pytorch import EMA
+import threading
 
 import librosa
 import numpy as np
-# import onnxruntime
 import soundfile
 import torch
+import torch.nn.functional as F
 import torchaudio
-from vocos import Vocos
 import torchaudio.transforms as T
 
-from accelerate import Accelerator
 import utils
-from model import NaturalSpeech2, Trainer
+from model import NaturalSpeech2
 
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-def load_mod(model_path, device, cfg):
-    data = torch.load(model_path, map_location=device)
-    model = NaturalSpeech2(cfg=cfg)
-    model.load_state_dict(data['model'])
+# marks the inference only checkpoints written by export_inference.py
+INFERENCE_FORMAT = "ns2vc-inference-1"
+
 
-    ema = EMA(model)
-    ema.to(device)
-    ema.load_state_dict(data["ema"])
-    return ema.ema_model
+def build_model(cfg, state_dict, frozen=False):
+    # built on the meta device, the state dict tensors become the parameters as they are,
+    # so no random init is paid for and memory mapped weights are not copied. frozen is the freeze_for_inference layout
+    with torch.device("meta"):
+        model = NaturalSpeech2(cfg=cfg)
+    if frozen:
+        model.freeze_for_inference()
+    model.load_state_dict(state_dict, assign=True)
+    return model
 
 
-def read_temp(file_name):
-    if not os.path.exists(file_name):
-        with open(file_name, "w") as f:
-            f.write(json.dumps({"info": "temp_dict"}))
-        return {}
+def load_mod(model_path, device, cfg):
+    # memory mapped, of a training checkpoint only the ema weights are ever read from disk
+    data = torch.load(model_path, map_location="cpu", mmap=True)
+    if data.get("format") == INFERENCE_FORMAT:
+        model = build_model(data["cfg"], data["model"], frozen=True)
     else:
-        try:
-            with open(file_name, "r") as f:
-                data = f.read()
-            data_dict = json.loads(data)
-            if os.path.getsize(file_name) > 50 * 1024 * 1024:
-                f_name = file_name.replace("\\", "/").split("/")[-1]
-                print(f"clean {f_name}")
-                for wav_hash in list(data_dict.keys()):
-                    if int(time.time()) - int(data_dict[wav_hash]["time"]) > 14 * 24 * 3600:
-                        del data_dict[wav_hash]
-        except Exception as e:
-            print(e)
-            print(f"{file_name} error,auto rebuild file")
-            data_dict = {"info": "temp_dict"}
-        return data_dict
-
-
-def write_temp(file_name, data):
-    with open(file_name, "w") as f:
-        f.write(json.dumps(data))
+        prefix = "ema_model."
+        model = build_model(cfg, {k[len(prefix):]: v for k, v in data["ema"].items() if k.startswith(prefix)})
+    # fp16 exports are cast back, the samplers run in float32.
+    # distilled checkpoints record the step count they were trained for
+    return model.to(device, torch.float32).eval(), data.get('sampling_timesteps', 200)
 
 
 def timeit(func):
@@ -90,9 +80,6 @@ def get_end_file(dir_path, end):
     return file_lists
 
 
-def get_md5(content):
-    return hashlib.new("md5", content).hexdigest()
-
 def fill_a_to_b(a, b):
     if len(a) < len(b):
         for _ in range(0, len(b) - len(a)):
@@ -119,62 +106,372 @@ def split_list_by_n(list_collection, n, pre=0):
         yield list_collection[i-pre if i-pre>=0 else i: i + n]
 
 
+def fix_length(arr, target_length):
+    # pad_array, and cut what the vocoder returned beyond the target
+    return pad_array(arr, target_length)[:target_length]
+
+
+def plan_segments(audio_data, audio_sr, target_sample, clip_seconds=0, lg_num=0):
+    # one (silent, source samples, output length, crossfade) per model call.
+    # slices longer than clip_seconds are cut into clips overlapping by lg_num, crossfade blends a clip into the one before
+    per_size = int(clip_seconds*audio_sr)
+    lg_size = int(lg_num*audio_sr)
+    plan = []
+    for (slice_tag, data) in audio_data:
+        datas = [data] if slice_tag or per_size == 0 else split_list_by_n(data, per_size, lg_size)
+        for k, dat in enumerate(datas):
+            plan.append((slice_tag, dat, int(np.ceil(len(dat) / audio_sr * target_sample)), k != 0 and lg_size != 0))
+    return plan
+
+
+def stream_plan(audio_path, target_sample, db_thresh=-40, min_len=5000, clip_seconds=0, lg_num=0, block_seconds=10):
+    # plan_segments entries of a source read block by block and cut by slicer.StreamingSlicer where Svc.cut cuts.
+    # only the samples since the last cut are held, so memory does not grow with the length of the source
+    with soundfile.SoundFile(audio_path) as f:
+        stream = slicer.StreamingSlicer(f.samplerate, threshold=db_thresh, min_length=min_len)
+
+        def plan(segments):
+            audio_data = [(silent, samples) for begin, end, silent, samples in segments if begin != end]
+            return plan_segments(audio_data, f.samplerate, target_sample, clip_seconds, lg_num)
+
+        for block in f.blocks(int(block_seconds * f.samplerate), dtype='float32', always_2d=True):
+            # the downmix of librosa.to_mono
+            yield from plan(stream.push(block.mean(axis=1)))
+        yield from plan(stream.flush())
+
+
+# sndfile.h, soundfile does not export it
+SFC_UPDATE_HEADER_NOW = 0x1060
+
+
+def update_header(sink):
+    # rewrite the length fields of the header of an open soundfile.SoundFile for the samples written so far,
+    # flush alone leaves them at zero until close
+    soundfile._snd.sf_command(sink._file, SFC_UPDATE_HEADER_NOW, soundfile._ffi.NULL, 0)
+    sink.flush()
+
+
+class OutputAssembler:
+    # the converted audio of a plan_segments plan, written into one preallocated float32 array.
+    # of the lg_num overlap of two clips, lgr_num in the middle is crossfaded in place and the rest is dropped.
+    # with a sink, an open soundfile.SoundFile, finished samples are written out as they complete and only
+    # the tail a following crossfade can still change is kept, so memory is bounded by the longest segment.
+    # plan can be None with a sink, for a plan that is not known in advance, the buffer then grows as segments come
+    def __init__(self, plan, target_sample, lg_num=0, lgr_num=0.75, sink=None):
+        lg_size = int(lg_num*target_sample)
+        self.lg_size_r = int(lg_size*lgr_num)
+        self.lg_size_c_l = (lg_size-self.lg_size_r)//2
+        self.lg_size_c_r = lg_size-self.lg_size_r-self.lg_size_c_l
+        self.fade = np.linspace(0, 1, self.lg_size_r, dtype=np.float32)
+        self.sink = sink
+        self.keep = self.lg_size_r + self.lg_size_c_r
+        if plan is None:
+            assert sink is not None, "without a sink the plan sizes the output"
+            self.length = None
+            size = self.keep
+        else:
+            self.length = sum(length for _, _, length, _ in plan) - lg_size * sum(crossfade for *_, crossfade in plan)
+            size = self.length if sink is None else self.keep + max((length for _, _, length, _ in plan), default=0)
+        self.audio = np.zeros(size, dtype=np.float32)
+        # output position of audio[0] and of the next sample
+        self.offset = 0
+        self.pos = 0
+
+    def reserve(self, end):
+        if end > len(self.audio):
+            self.audio = np.concatenate([self.audio, np.zeros(end - len(self.audio), dtype=np.float32)])
+
+    def silence(self, length):
+        # already zero
+        self.pos += length
+        self.reserve(self.pos - self.offset)
+        self.flush()
+
+    def add(self, segment, length, crossfade=False):
+        segment = fix_length(np.asarray(segment, dtype=np.float32), length)
+        if crossfade:
+            self.pos -= self.lg_size_c_r
+            end = self.pos - self.offset
+            tail = self.audio[end-self.lg_size_r:end]
+            tail *= 1 - self.fade
+            tail += segment[self.lg_size_c_l:self.lg_size_c_l+self.lg_size_r] * self.fade
+            segment = segment[self.lg_size_c_l+self.lg_size_r:]
+        start = self.pos - self.offset
+        self.reserve(start + len(segment))
+        self.audio[start:start+len(segment)] = segment
+        self.pos += len(segment)
+        self.flush()
+
+    def flush(self, final=False):
+        # write everything no crossfade can reach any more and move the tail to the front
+        if self.sink is None:
+            return
+        done = self.pos - self.offset - (0 if final else self.keep)
+        if done <= 0:
+            return
+        self.sink.write(self.audio[:done])
+        # a file of an interrupted run stays readable up to here
+        update_header(self.sink)
+        rest = self.pos - self.offset - done
+        self.audio[:rest] = self.audio[done:done+rest]
+        self.audio[rest:] = 0
+        self.offset += done
+
+    def close(self):
+        if self.sink is not None:
+            self.flush(final=True)
+            self.sink.close()
+
+
 class F0FilterException(Exception):
     pass
 
+
+# frame counts inputs are padded up to in compiled mode, longer inputs go to a multiple of the last one
+BUCKETS = [64, 128, 256, 384, 512, 768, 1024, 1536, 2048]
+
+
+def bucket_length(length, buckets=BUCKETS):
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return -(-length // buckets[-1]) * buckets[-1]
+
 class Svc(object):
+    # loaded on first use with lazy=True, or again after unload_model
+    LAZY = {"model": "load_model", "sampling_timesteps": "load_model", "hubert_model": "load_hubert", "vocoder": "load_vocoder"}
+
     def __init__(self, model_path, config_path,
                  device=None,
+                 backend='torch',
+                 onnx_dir=None,
+                 quantize=None,
+                 compile=False,
+                 buckets=None,
+                 batch_sizes=None,
+                 speaker_library=None,
+                 feature_cache=None,
+                 feature_cache_bytes=2 * 1024 ** 3,
+                 extract_workers=2,
+                 lazy=False,
                  ):
         self.model_path = model_path
+        # 'onnx' runs the graphs written by export_onnx.py, by default from <model_path without suffix>_onnx
+        self.backend = backend
+        self.onnx_dir = onnx_dir or os.path.splitext(model_path)[0] + "_onnx"
+        # int8 cpu inference of the torch backend, 'dynamic' or 'weight', see quantize.py
+        self.quantize = quantize
+        # torch.compile the denoiser step, inputs are padded to bucket sizes so every bucket compiles once
+        self.compile = compile
+        self.buckets = buckets or BUCKETS
+        # rows per sampling run that are compiled at startup, fan-out and batched serving run several
+        self.batch_sizes = sorted(set(batch_sizes or [1]))
+        # slicer chunks and source features by audio content, None extracts everything every time
+        self.feature_cache = FeatureCache(feature_cache, feature_cache_bytes) if feature_cache else None
+        # named speakers with stored reference mels and prompts, written by make_speaker_library.py
+        self.speaker_library = SpeakerLibrary(speaker_library) if speaker_library else None
+        # f0 and the reference mel are extracted here while contentvec runs in the calling thread,
+        # parselmouth, librosa and torch release the GIL. stage_times holds the seconds of the last extraction
+        self.extract_pool = ThreadPoolExecutor(extract_workers)
+        self.stage_times = {}
+        if self.speaker_library is not None and self.speaker_library.index["model"] != str(model_path):
+            print(f"speaker library {speaker_library} was built with {self.speaker_library.index['model']}, its prompts may not fit {model_path}")
         if device is None:
             self.dev = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             self.dev = torch.device(device)
-        self.model = None
         self.cfg = json.load(open(config_path))
         self.target_sample = self.cfg['data']['sampling_rate']
         self.hop_size = self.cfg['data']['hop_length']
-        # load hubert
+        # seconds spent loading each of the LAZY parts
+        self.load_times = {}
+        self.load_lock = threading.RLock()
+        if not lazy:
+            # through __getattr__, like a first use
+            for name in ("hubert_model", "model", "vocoder"):
+                getattr(self, name)
+        if self.compile:
+            self.warmup()
+
+    def __getattr__(self, name):
+        # only reached for attributes that are not set
+        loader = Svc.LAZY.get(name)
+        if loader is None or "load_lock" not in self.__dict__:
+            raise AttributeError(name)
+        with self.load_lock:
+            if name not in self.__dict__:
+                start = time.time()
+                getattr(self, loader)()
+                self.load_times[loader[5:]] = time.time() - start
+        return self.__dict__[name]
+
+    def load_hubert(self):
         self.hubert_model = utils.get_hubert_model().to(self.dev)
-        self.load_model()
-        self.vocos = Vocos.from_pretrained("charactr/vocos-mel-24khz")
+
+    def load_vocoder(self):
+        self.vocoder = Vocoder(self.dev)
 
     def load_model(self):
-        self.model = load_mod(self.model_path, self.dev, self.cfg)
-        self.model.eval()
+        # no non-finite checks at inference time
+        utils.numeric_guard.configure('off')
+        self.model, self.sampling_timesteps = load_mod(self.model_path, self.dev, self.cfg)
+        self.model.freeze_for_inference()
+        if self.backend == 'onnx':
+            from inference import onnx_backend
+            providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if self.dev.type == "cuda" else ["CPUExecutionProvider"]
+            pre_model, diff_model = onnx_backend.load_onnx(self.onnx_dir, providers)
+            onnx_backend.check_onnx(self.model, pre_model, diff_model)
+            # the samplers only go through pre_model.infer, diff_model.encode_cond and diff_model.forward_step
+            self.model.pre_model, self.model.diff_model = pre_model, diff_model
+        elif self.quantize is not None:
+            import quantize
+            assert self.dev.type == "cpu", "int8 inference runs on cpu"
+            self.model = quantize.quantize(self.model, self.quantize)
+        if self.compile:
+            assert self.backend == 'torch', "compile needs the torch backend"
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(self.buckets) * len(self.batch_sizes))
+            # the instance attribute shadows the method, the samplers pick it up unchanged
+            self.model.diff_model.forward_step = torch.compile(self.model.diff_model.forward_step, dynamic=False)
+
+    def warmup(self):
+        # compile every bucket for every batch size
+        for batch_size in self.batch_sizes:
+            for bucket in self.buckets:
+                start = time.time()
+                c = torch.zeros(batch_size, 256, bucket, device=self.dev)
+                refer = torch.zeros(batch_size, 100, bucket, device=self.dev)
+                f0 = torch.zeros(batch_size, bucket, device=self.dev)
+                lengths = torch.LongTensor([bucket] * batch_size).to(self.dev)
+                with torch.no_grad():
+                    self.model.sample(c, refer, f0, f0, lengths, lengths, None, sampling_timesteps=1)
+                print("warmup bucket {} x{} use time:{}".format(bucket, batch_size, time.time() - start))
+
+    def sample(self, c, refer, f0, uv, lengths, refer_lengths, **kwargs):
+        return self.vocoder.decode(self.sample_mel(c, refer, f0, uv, lengths, refer_lengths, **kwargs))
+
+    def sample_mel(self, c, refer, f0, uv, lengths, refer_lengths, **kwargs):
+        # model.sample without the vocoder, in compiled mode on inputs padded to the bucket sizes, the masks make the padding harmless
+        if not self.compile:
+            return self.model.sample(c, refer, f0, uv, lengths, refer_lengths, None, **kwargs)
+        frames = c.shape[2]
+        pad = bucket_length(frames, self.buckets) - frames
+        c, f0, uv = F.pad(c, (0, pad)), F.pad(f0, (0, pad)), F.pad(uv, (0, pad))
+        refer = F.pad(refer, (0, bucket_length(refer.shape[2], self.buckets) - refer.shape[2]))
+        mel = self.model.sample(c, refer, f0, uv, lengths, refer_lengths, None, **kwargs)
+        return mel[:, :, :frames]
+
+    def batch_variants(self, c, f0, uv, variants):
+        # one row per (refer, audio_prompt, tran) variant, all sharing the untransposed source features.
+        # audio_prompt is None, or T x 1 x C from get_speaker for every variant
+        refer_lengths = torch.LongTensor([refer.shape[2] for refer, _, _ in variants]).to(self.dev)
+        refer_frames = int(refer_lengths.max())
+        refer_padded = torch.zeros(len(variants), variants[0][0].shape[1], refer_frames, device=self.dev)
+        audio_prompt = None
+        if variants[0][1] is not None:
+            audio_prompt = torch.zeros(refer_frames, len(variants), variants[0][1].shape[2], device=self.dev)
+        for i, (refer, prompt, _) in enumerate(variants):
+            refer_padded[i, :, :refer.shape[2]] = refer[0]
+            if audio_prompt is not None:
+                audio_prompt[:prompt.shape[0], i] = prompt[:, 0]
+        scale = torch.FloatTensor([2 ** (tran / 12) for _, _, tran in variants]).to(self.dev)
+        f0 = f0.repeat(len(variants), 1) * scale.unsqueeze(1)
+        c = c.repeat(len(variants), 1, 1)
+        uv = uv.repeat(len(variants), 1)
+        lengths = torch.LongTensor([c.shape[2]] * len(variants)).to(self.dev)
+        return c, refer_padded, f0, uv, lengths, refer_lengths, audio_prompt
+
+    def load_audio(self, source, sr=None):
+        # source is a path, a file object or an (array, sample rate) pair of a numpy array or torch tensor.
+        # returns mono float32 and its sample rate, resampled only if sr is given and differs
+        if isinstance(source, tuple):
+            wav, source_sr = source
+            if isinstance(wav, torch.Tensor):
+                wav = wav.detach().cpu().numpy()
+            wav = np.asarray(wav, dtype=np.float32)
+            if wav.ndim > 1:
+                wav = librosa.to_mono(wav)
+        else:
+            wav, source_sr = librosa.load(source, sr=None)
+        if sr is not None and sr != source_sr:
+            wav = librosa.resample(wav, orig_sr=source_sr, target_sr=sr)
+            source_sr = sr
+        return wav, source_sr
+
+    def timed(self, stage, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.stage_times[stage] = time.time() - start
+        return result
+
+    def print_stage_times(self):
+        print("features " + ", ".join(f"{stage} {t:.3f}s" for stage, t in self.stage_times.items()))
+
+    def get_unit_f0(self, in_path, tran, f0_filter, F0_mean_pooling, cr_threshold=0.05):
+        # c, f0, uv of the source audio, in_path as in load_audio
+        wav, sr = self.timed("load", self.load_audio, in_path, self.target_sample)
+        c, f0, uv = self.extract_unit_f0(wav, F0_mean_pooling, cr_threshold)
+        if f0_filter and f0.sum() == 0:
+            raise F0FilterException("No voice detected")
+        f0 = f0 * 2 ** (tran / 12)
+        return c, f0, uv
+
+    def extract_unit_f0(self, wav, F0_mean_pooling, cr_threshold=0.05):
+        # untransposed, so one cache entry serves every tran
+        if self.feature_cache is not None:
+            key = FeatureCache.key("unit_f0", wav, self.target_sample, self.hop_size, F0_mean_pooling, cr_threshold)
+            cached = self.feature_cache.get(key)
+            if cached is not None:
+                return tuple(torch.from_numpy(cached[name]).unsqueeze(0).to(self.dev) for name in ("c", "f0", "uv"))
+
+        f0_uv = self.extract_pool.submit(self.timed, "f0", self.extract_f0, wav, F0_mean_pooling, cr_threshold)
+        c = self.timed("content", self.extract_content, wav)
+        f0, uv = f0_uv.result()
+        c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[1])
 
-    def get_unit_f0_code(self, in_path, tran, refer_path, f0_filter ,F0_mean_pooling,cr_threshold=0.05):
-        # c, refer, f0, uv, lengths, refer_lengths
-        wav, sr = librosa.load(in_path, sr=self.target_sample)
+        c = c.unsqueeze(0).to(self.dev)
+        if self.feature_cache is not None:
+            self.feature_cache.put(key, c=c[0].cpu().numpy(), f0=f0[0].cpu().numpy(), uv=uv[0].cpu().numpy())
+        return c, f0, uv
 
+    def extract_f0(self, wav, F0_mean_pooling, cr_threshold=0.05):
         if F0_mean_pooling == True:
             f0, uv = utils.compute_f0_uv_torchcrepe(torch.FloatTensor(wav), sampling_rate=self.target_sample, hop_length=self.hop_size,device=self.dev,cr_threshold = cr_threshold)
-            if f0_filter and sum(f0) == 0:
-                raise F0FilterException("No voice detected")
             f0 = torch.FloatTensor(list(f0))
             uv = torch.FloatTensor(list(uv))
         if F0_mean_pooling == False:
             f0 = utils.compute_f0_parselmouth(wav, sampling_rate=self.target_sample, hop_length=self.hop_size)
-            if f0_filter and sum(f0) == 0:
-                raise F0FilterException("No voice detected")
             f0, uv = utils.interpolate_f0(f0)
             f0 = torch.FloatTensor(f0)
             uv = torch.FloatTensor(uv)
 
-        f0 = f0 * 2 ** (tran / 12)
         f0 = f0.unsqueeze(0).to(self.dev)
         uv = uv.unsqueeze(0).to(self.dev)
+        return f0, uv
 
+    def extract_content(self, wav):
+        # contentvec units at their own frame rate, 1 x C x T
         wav16k = librosa.resample(wav, orig_sr=self.target_sample, target_sr=16000)
         wav16k = torch.from_numpy(wav16k).to(self.dev)
-        c = utils.get_hubert_content(self.hubert_model, wav_16k_tensor=wav16k)
-        c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[1])
-
-        c = c.unsqueeze(0).to(self.dev)
-
-        refer_wav, sr = torchaudio.load(refer_path)
-        wav24k = T.Resample(sr, 24000)(refer_wav)
+        return utils.get_hubert_content(self.hubert_model, wav_16k_tensor=wav16k)
+
+    def cut(self, audio, sr, db_thresh=-40, min_len=5000):
+        # slicer.cut_audio, keyed by the samples
+        if self.feature_cache is None:
+            return slicer.cut_audio(audio, sr, db_thresh=db_thresh, min_len=min_len)
+        key = FeatureCache.key("cut", audio, sr, db_thresh, min_len)
+        cached = self.feature_cache.get(key)
+        if cached is not None:
+            return cached["chunks"]
+        chunks = slicer.cut_audio(audio, sr, db_thresh=db_thresh, min_len=min_len)
+        self.feature_cache.put(key, chunks=chunks)
+        return chunks
+
+    def get_refer(self, refer_path):
+        # refer_path is a path, a file object or an (array, sample rate) pair of mono audio
+        if isinstance(refer_path, tuple):
+            assert np.ndim(refer_path[0]) == 1, "reference audio arrays have to be mono"
+        refer_wav, sr = self.load_audio(refer_path)
+        wav24k = T.Resample(sr, 24000)(torch.from_numpy(refer_wav).unsqueeze(0))
         spec_process = torchaudio.transforms.MelSpectrogram(
             sample_rate=24000,
             n_fft=1024,
@@ -185,7 +482,22 @@ class Svc(object):
         )
         spec = spec_process(wav24k)# 1 100 T
         spec = torch.log(torch.clip(spec, min=1e-7))
-        refer = spec.to(self.dev)
+        return spec.to(self.dev)
+
+    def get_speaker(self, speaker):
+        # refer and audio_prompt of a library speaker, without audio or the prompt encoder
+        assert self.speaker_library is not None, "Svc was created without a speaker_library"
+        return self.speaker_library.get(speaker, self.dev)
+
+    def get_unit_f0_code(self, in_path, tran, refer_path, f0_filter ,F0_mean_pooling,cr_threshold=0.05):
+        # c, refer, f0, uv, lengths, refer_lengths
+        self.stage_times = {}
+        start = time.time()
+        refer = self.extract_pool.submit(self.timed, "refer", self.get_refer, refer_path)
+        c, f0, uv = self.get_unit_f0(in_path, tran, f0_filter, F0_mean_pooling, cr_threshold=cr_threshold)
+        refer = refer.result()
+        self.stage_times["total"] = time.time() - start
+        self.print_stage_times()
 
         lengths = torch.LongTensor([c.shape[2]]).to(self.dev)
         refer_lengths = torch.LongTensor([refer.shape[2]]).to(self.dev)
@@ -194,22 +506,69 @@ class Svc(object):
 
     def infer(self, tran,
             raw_path,
-            refer_path,
+            refer_path=None,
             auto_predict_f0=False,
             f0_filter=False,
             F0_mean_pooling=False,
-            cr_threshold = 0.05
+            cr_threshold = 0.05,
+            sample_method = 'ddim',
+            sampling_timesteps = None,
+            speaker = None
         ):
-
-        c, refer, f0, uv, lengths, refer_lengths = self.get_unit_f0_code(raw_path, tran, refer_path, f0_filter,F0_mean_pooling,cr_threshold=cr_threshold)
+        # the target voice is either a reference clip or a speaker of the library
+        sampling_timesteps = sampling_timesteps or self.sampling_timesteps
+
+        self.stage_times = {}
+        start = time.time()
+        refer = None if speaker is not None else self.extract_pool.submit(self.timed, "refer", self.get_refer, refer_path)
+        c, f0, uv = self.get_unit_f0(raw_path, tran, f0_filter, F0_mean_pooling, cr_threshold=cr_threshold)
+        if speaker is not None:
+            refer, audio_prompt = self.get_speaker(speaker)
+        else:
+            refer, audio_prompt = refer.result(), None
+        self.stage_times["total"] = time.time() - start
+        self.print_stage_times()
+        lengths = torch.LongTensor([c.shape[2]]).to(self.dev)
+        refer_lengths = torch.LongTensor([refer.shape[2]]).to(self.dev)
         with torch.no_grad():
             start = time.time()
-            audio = self.model.sample(c, refer, f0, uv, lengths, refer_lengths, self.vocos, auto_predict_f0 =auto_predict_f0)[0].detach().cpu()
+            audio = self.sample(c, refer, f0, uv, lengths, refer_lengths, auto_predict_f0 =auto_predict_f0,
+                                sampling_timesteps=sampling_timesteps, sample_method=sample_method,
+                                audio_prompt=audio_prompt)[0].detach().cpu()
             # print(audio.shape)
             use_time = time.time() - start
             print("ns2vc use time:{}".format(use_time))
         return audio, audio.shape[-1]
 
+    def infer_fan_out(self, trans,
+            raw_path,
+            refer_paths,
+            auto_predict_f0=False,
+            f0_filter=False,
+            F0_mean_pooling=False,
+            cr_threshold = 0.05,
+            sample_method = 'ddim',
+            sampling_timesteps = None
+        ):
+        sampling_timesteps = sampling_timesteps or self.sampling_timesteps
+        # one row per (refer, tran) pair, all sharing the source features
+        self.stage_times = {}
+        start = time.time()
+        refers = self.extract_pool.submit(self.timed, "refer", lambda: [self.get_refer(refer_path) for refer_path in refer_paths])
+        c, f0, uv = self.get_unit_f0(raw_path, 0, f0_filter, F0_mean_pooling, cr_threshold=cr_threshold)
+        refers = refers.result()
+        self.stage_times["total"] = time.time() - start
+        self.print_stage_times()
+        pairs = [(refer, None, tran) for refer in refers for tran in trans]
+        c, refer_padded, f0, uv, lengths, refer_lengths, _ = self.batch_variants(c, f0, uv, pairs)
+        with torch.no_grad():
+            start = time.time()
+            audio = self.sample(c, refer_padded, f0, uv, lengths, refer_lengths, auto_predict_f0 =auto_predict_f0,
+                                sampling_timesteps=sampling_timesteps, sample_method=sample_method).detach().cpu()
+            use_time = time.time() - start
+            print("ns2vc fan-out x{} use time:{}".format(len(pairs), use_time))
+        return [audio[i] for i in range(len(pairs))]
+
     def clear_empty(self):
         # clean up vram
         torch.cuda.empty_cache()
@@ -222,120 +581,42 @@ class Svc(object):
 
     def slice_inference(self,
                         raw_audio_path,
-                        spk,
+                        refer_path,
                         tran,
                         slice_db,
-                        cluster_infer_ratio,
                         auto_predict_f0,
-                        noice_scale,
                         pad_seconds=0.5,
                         clip_seconds=0,
                         lg_num=0,
                         lgr_num =0.75,
                         F0_mean_pooling = False,
-                        enhancer_adaptive_key = 0,
-                        cr_threshold = 0.05
+                        cr_threshold = 0.05,
+                        sample_method = 'ddim',
+                        sampling_timesteps = None,
+                        speaker = None
                         ):
-        wav_path = raw_audio_path
-        chunks = slicer.cut(wav_path, db_thresh=slice_db)
-        audio_data, audio_sr = slicer.chunks2audio(wav_path, chunks)
-        per_size = int(clip_seconds*audio_sr)
-        lg_size = int(lg_num*audio_sr)
-        lg_size_r = int(lg_size*lgr_num)
-        lg_size_c_l = (lg_size-lg_size_r)//2
-        lg_size_c_r = lg_size-lg_size_r-lg_size_c_l
-        lg = np.linspace(0,1,lg_size_r) if lg_size!=0 else 0
-        
-        audio = []
-        for (slice_tag, data) in audio_data:
-            print(f'#=====segment start, {round(len(data) / audio_sr, 3)}s======')
-            # padd
-            length = int(np.ceil(len(data) / audio_sr * self.target_sample))
-            if slice_tag:
-                print('jump empty segment')
-                _audio = np.zeros(length)
-                audio.extend(list(pad_array(_audio, length)))
-                continue
-            if per_size != 0:
-                datas = split_list_by_n(data, per_size,lg_size)
-            else:
-                datas = [data]
-            for k,dat in enumerate(datas):
-                per_length = int(np.ceil(len(dat) / audio_sr * self.target_sample)) if clip_seconds!=0 else length
-                if clip_seconds!=0: print(f'###=====segment clip start, {round(len(dat) / audio_sr, 3)}s======')
-                # padd
-                pad_len = int(audio_sr * pad_seconds)
-                dat = np.concatenate([np.zeros([pad_len]), dat, np.zeros([pad_len])])
-                raw_path = io.BytesIO()
-                soundfile.write(raw_path, dat, audio_sr, format="wav")
-                raw_path.seek(0)
-                out_audio, out_sr = self.infer(spk, tran, raw_path,
-                                                    cluster_infer_ratio=cluster_infer_ratio,
-                                                    auto_predict_f0=auto_predict_f0,
-                                                    noice_scale=noice_scale,
-                                                    F0_mean_pooling = F0_mean_pooling,
-                                                    enhancer_adaptive_key = enhancer_adaptive_key,
-                                                    cr_threshold = cr_threshold
-                                                    )
-                _audio = out_audio.cpu().numpy()
-                pad_len = int(self.target_sample * pad_seconds)
-                _audio = _audio[pad_len:-pad_len]
-                _audio = pad_array(_audio, per_length)
-                if lg_size!=0 and k!=0:
-                    lg1 = audio[-(lg_size_r+lg_size_c_r):-lg_size_c_r] if lgr_num != 1 else audio[-lg_size:]
-                    lg2 = _audio[lg_size_c_l:lg_size_c_l+lg_size_r]  if lgr_num != 1 else _audio[0:lg_size]
-                    lg_pre = lg1*(1-lg)+lg2*lg
-                    audio = audio[0:-(lg_size_r+lg_size_c_r)] if lgr_num != 1 else audio[0:-lg_size]
-                    audio.extend(lg_pre)
-                    _audio = _audio[lg_size_c_l+lg_size_r:] if lgr_num != 1 else _audio[lg_size:]
-                audio.extend(list(_audio))
-        return np.array(audio)
-
-class RealTimeVC:
-    def __init__(self):
-        self.last_chunk = None
-        self.last_o = None
-        self.chunk_len = 16000  # chunk length
-        self.pre_len = 3840  # cross fade length, multiples of 640
-
-    # Input and output are 1-dimensional numpy waveform arrays
-
-    def process(self, svc_model, speaker_id, f_pitch_change, input_wav_path,
-                cluster_infer_ratio=0,
-                auto_predict_f0=False,
-                noice_scale=0.4,
-                f0_filter=False):
-
-        import maad
-        audio, sr = torchaudio.load(input_wav_path)
-        audio = audio.cpu().numpy()[0]
-        temp_wav = io.BytesIO()
-        if self.last_chunk is None:
-            input_wav_path.seek(0)
-
-            audio, sr = svc_model.infer(speaker_id, f_pitch_change, input_wav_path,
-                                        cluster_infer_ratio=cluster_infer_ratio,
-                                        auto_predict_f0=auto_predict_f0,
-                                        noice_scale=noice_scale,
-                                        f0_filter=f0_filter)
-
-            audio = audio.cpu().numpy()
-            self.last_chunk = audio[-self.pre_len:]
-            self.last_o = audio
-            return audio[-self.chunk_len:]
+        # raw_audio_path as in load_audio, it is decoded once and the slices are views of it
+        audio_data, audio_sr = self.load_audio(raw_audio_path)
+        chunks = self.cut(audio_data, audio_sr, db_thresh=slice_db)
+        audio_data = slicer.split(audio_data, chunks)
+        plan = plan_segments(audio_data, audio_sr, self.target_sample, clip_seconds, lg_num)
+        audio = OutputAssembler(plan, self.target_sample, lg_num, lgr_num)
+        if speaker is not None:
+            variants = [(*self.get_speaker(speaker), tran)]
         else:
-            audio = np.concatenate([self.last_chunk, audio])
-            soundfile.write(temp_wav, audio, sr, format="wav")
-            temp_wav.seek(0)
-
-            audio, sr = svc_model.infer(speaker_id, f_pitch_change, temp_wav,
-                                        cluster_infer_ratio=cluster_infer_ratio,
-                                        auto_predict_f0=auto_predict_f0,
-                                        noice_scale=noice_scale,
-                                        f0_filter=f0_filter)
-
-            audio = audio.cpu().numpy()
-            ret = maad.util.crossfade(self.last_o, audio, self.pre_len)
-            self.last_chunk = audio[-self.pre_len:]
-            self.last_o = audio
-            return ret[self.chunk_len:2 * self.chunk_len]
+            variants = [(self.get_refer(refer_path), None, tran)]
+        pipeline = segment_pipeline(self, variants, audio_sr,
+                                    pad_seconds = pad_seconds,
+                                    auto_predict_f0 = auto_predict_f0,
+                                    F0_mean_pooling = F0_mean_pooling,
+                                    cr_threshold = cr_threshold,
+                                    sample_method = sample_method,
+                                    sampling_timesteps = sampling_timesteps
+                                    )
+        for (slice_tag, dat, length, crossfade), out_audios in zip(plan, pipeline.run(plan)):
+            if out_audios is None:
+                audio.silence(length)
+            else:
+                audio.add(out_audios[0], length, crossfade)
+        pipeline.report()
+        return audio.audio
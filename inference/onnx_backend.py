@@ -0,0 +1,262 @@
+import logging
+import os
+
+import torch
+from torch import nn
+
+PROMPT = "prompt.onnx"
+PRE_MODEL = "pre_model.onnx"
+DIFF_COND = "diff_cond.onnx"
+DIFF_STEP = "diff_step.onnx"
+
+PROMPT_INPUTS = ["refer", "refer_lengths"]
+PRE_MODEL_INPUTS = ["c", "audio_prompt", "f0", "uv", "lengths", "refer_lengths", "auto_predict_f0", "f0_scale"]
+DIFF_COND_INPUTS = ["content", "audio_prompt", "lengths", "refer_lengths"]
+DIFF_STEP_INPUTS = ["x", "t", "contentvec", "x_mask", "q_prompt_mask"]
+
+
+def prompt_names(n):
+    return [f"prompt_{i}" for i in range(n)]
+
+
+# graphs as they are exported, every input and output is a plain tensor
+
+class PromptGraph(nn.Module):
+    def __init__(self, pre_model):
+        super().__init__()
+        self.pre_model = pre_model
+
+    def forward(self, refer, refer_lengths):
+        return self.pre_model.encode_prompt(refer, refer_lengths)
+
+
+class PreModelGraph(nn.Module):
+    # takes the encoded prompt, so a cached one skips the prompt encoder
+    def __init__(self, pre_model):
+        super().__init__()
+        self.pre_model = pre_model
+
+    def forward(self, c, audio_prompt, f0, uv, lengths, refer_lengths, auto_predict_f0, f0_scale):
+        data = (c, None, f0, 0, 0, lengths, refer_lengths, uv)
+        return self.pre_model.infer(data, auto_predict_f0=auto_predict_f0, f0_scale=f0_scale, audio_prompt=audio_prompt)[0]
+
+
+class DiffCondGraph(nn.Module):
+    def __init__(self, diff_model):
+        super().__init__()
+        self.diff_model = diff_model
+
+    def forward(self, content, refer, lengths, refer_lengths):
+        contentvec, prompts, x_mask, q_prompt_mask = self.diff_model.encode_cond((content, refer, lengths, refer_lengths))
+        return (contentvec, x_mask, q_prompt_mask, *prompts)
+
+
+class DiffStepGraph(nn.Module):
+    def __init__(self, diff_model):
+        super().__init__()
+        self.diff_model = diff_model
+
+    def forward(self, x, t, contentvec, x_mask, q_prompt_mask, *prompts):
+        return self.diff_model.forward_step(x, (contentvec, list(prompts), x_mask, q_prompt_mask), t)
+
+
+def dummy_inputs(model, batch=1, frames=200, refer_frames=300, device="cpu"):
+    c = torch.randn(batch, 256, frames, device=device)
+    refer = torch.randn(batch, 100, refer_frames, device=device)
+    f0 = torch.rand(batch, frames, device=device) * 200 + 100
+    uv = torch.ones(batch, frames, device=device)
+    lengths = torch.full((batch,), frames, dtype=torch.long, device=device)
+    refer_lengths = torch.full((batch,), refer_frames, dtype=torch.long, device=device)
+    return c, refer, f0, uv, lengths, refer_lengths
+
+
+def export_onnx(model, out_dir, opset_version=17):
+    # the prompt encoder, the rest of Pre_model.infer, the step independent conditioning and the per step denoiser
+    # as four graphs, the step graph is the one that runs sampling_timesteps times so it carries nothing else
+    model = model.eval().cpu()
+    os.makedirs(out_dir, exist_ok=True)
+    prompts_out = prompt_names(len(model.diff_model.prompt_proj))
+    c, refer, f0, uv, lengths, refer_lengths = dummy_inputs(model)
+    auto_predict_f0 = torch.tensor(False)
+    f0_scale = torch.ones(c.shape[0], 1)
+
+    with torch.no_grad():
+        data = (c, refer, f0, 0, 0, lengths, refer_lengths, uv)
+        content, audio_prompt = model.pre_model.infer(data, auto_predict_f0=auto_predict_f0, f0_scale=f0_scale)
+        contentvec, prompts, x_mask, q_prompt_mask = model.diff_model.encode_cond((content, audio_prompt, lengths, refer_lengths))
+        x = torch.randn(c.shape[0], model.dim, c.shape[2])
+        t = torch.full((c.shape[0],), 500, dtype=torch.long)
+
+        torch.onnx.export(
+            PromptGraph(model.pre_model).eval(),
+            (refer, refer_lengths),
+            os.path.join(out_dir, PROMPT),
+            input_names=PROMPT_INPUTS,
+            output_names=["audio_prompt"],
+            dynamic_axes={
+                "refer": {0: "batch", 2: "refer_frames"},
+                "refer_lengths": {0: "batch"},
+                "audio_prompt": {0: "refer_frames", 1: "batch"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        torch.onnx.export(
+            PreModelGraph(model.pre_model).eval(),
+            (c, audio_prompt, f0, uv, lengths, refer_lengths, auto_predict_f0, f0_scale),
+            os.path.join(out_dir, PRE_MODEL),
+            input_names=PRE_MODEL_INPUTS,
+            output_names=["content"],
+            dynamic_axes={
+                "c": {0: "batch", 2: "frames"},
+                "audio_prompt": {0: "refer_frames", 1: "batch"},
+                "f0": {0: "batch", 1: "frames"},
+                "uv": {0: "batch", 1: "frames"},
+                "lengths": {0: "batch"},
+                "refer_lengths": {0: "batch"},
+                "f0_scale": {0: "batch"},
+                "content": {0: "frames", 1: "batch"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        torch.onnx.export(
+            DiffCondGraph(model.diff_model).eval(),
+            (content, audio_prompt, lengths, refer_lengths),
+            os.path.join(out_dir, DIFF_COND),
+            input_names=DIFF_COND_INPUTS,
+            output_names=["contentvec", "x_mask", "q_prompt_mask", *prompts_out],
+            dynamic_axes={
+                "content": {0: "frames", 1: "batch"},
+                "audio_prompt": {0: "refer_frames", 1: "batch"},
+                "lengths": {0: "batch"},
+                "refer_lengths": {0: "batch"},
+                "contentvec": {0: "frames", 1: "batch"},
+                "x_mask": {0: "batch", 1: "frames"},
+                "q_prompt_mask": {0: "batch"},
+                **{name: {1: "batch"} for name in prompts_out},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        torch.onnx.export(
+            DiffStepGraph(model.diff_model).eval(),
+            (x, t, contentvec, x_mask, q_prompt_mask, *prompts),
+            os.path.join(out_dir, DIFF_STEP),
+            input_names=[*DIFF_STEP_INPUTS, *prompts_out],
+            output_names=["x_start"],
+            dynamic_axes={
+                "x": {0: "batch", 2: "frames"},
+                "t": {0: "batch"},
+                "contentvec": {0: "frames", 1: "batch"},
+                "x_mask": {0: "batch", 1: "frames"},
+                "q_prompt_mask": {0: "batch"},
+                **{name: {1: "batch"} for name in prompts_out},
+                "x_start": {0: "batch", 2: "frames"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+
+# runtime, drop-in replacements for model.pre_model and model.diff_model so the samplers run unchanged
+
+def _session(path, providers):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(path, options, providers=providers)
+
+
+def _run(session, names, inputs):
+    # the exporter drops inputs the graph never reads, e.g. the prompt of a cross attention whose output is unused
+    used = {i.name for i in session.get_inputs()}
+    feeds = {name: value.detach().cpu().numpy() for name, value in zip(names, inputs) if name in used}
+    return [torch.from_numpy(out) for out in session.run(None, feeds)]
+
+
+class OnnxPreModel(nn.Module):
+    def __init__(self, prompt_path, path, providers):
+        super().__init__()
+        self.prompt_session = _session(prompt_path, providers)
+        self.session = _session(path, providers)
+
+    def encode_prompt(self, refer_padded, refer_lengths):
+        audio_prompt, = _run(self.prompt_session, PROMPT_INPUTS, (refer_padded, refer_lengths))
+        return audio_prompt.to(refer_padded.device)
+
+    def infer(self, data, auto_predict_f0=None, f0_scale=None, audio_prompt=None):
+        # a cached audio_prompt skips the prompt graph
+        c, refer, f0, _, _, lengths, refer_lengths, uv = data
+        if audio_prompt is None:
+            audio_prompt = self.encode_prompt(refer, refer_lengths)
+        if f0_scale is None:
+            # same random scale utils.normalize_f0 draws in the torch model
+            f0_scale = torch.Tensor(c.shape[0], 1).uniform_(0.8, 1.2)
+        auto_predict_f0 = torch.tensor(auto_predict_f0 != False)
+        content, = _run(self.session, PRE_MODEL_INPUTS,
+                        (c, audio_prompt, f0, uv, lengths, refer_lengths, auto_predict_f0, f0_scale))
+        return content.to(c.device), audio_prompt
+
+
+class OnnxDiffusionEncoder(nn.Module):
+    def __init__(self, cond_path, step_path, providers):
+        super().__init__()
+        self.cond_session = _session(cond_path, providers)
+        self.step_session = _session(step_path, providers)
+
+    def encode_cond(self, data):
+        device = data[0].device
+        contentvec, x_mask, q_prompt_mask, *prompts = _run(self.cond_session, DIFF_COND_INPUTS, data)
+        return contentvec.to(device), [p.to(device) for p in prompts], x_mask.to(device), q_prompt_mask.to(device)
+
+    def forward_step(self, x, cond, t):
+        contentvec, prompts, x_mask, q_prompt_mask = cond
+        x_start, = _run(self.step_session, [*DIFF_STEP_INPUTS, *prompt_names(len(prompts))],
+                        (x, t, contentvec, x_mask, q_prompt_mask, *prompts))
+        return x_start.to(x.device)
+
+    def forward(self, x, data, t):
+        return self.forward_step(x, self.encode_cond(data), t)
+
+
+def load_onnx(onnx_dir, providers=None):
+    providers = providers or ["CPUExecutionProvider"]
+    if not os.path.exists(os.path.join(onnx_dir, PROMPT)):
+        raise FileNotFoundError(f"{onnx_dir} has no {PROMPT}, it was exported before the prompt encoder had its own graph, run export_onnx.py again")
+    pre_model = OnnxPreModel(os.path.join(onnx_dir, PROMPT), os.path.join(onnx_dir, PRE_MODEL), providers)
+    diff_model = OnnxDiffusionEncoder(os.path.join(onnx_dir, DIFF_COND), os.path.join(onnx_dir, DIFF_STEP), providers)
+    return pre_model, diff_model
+
+
+def check_onnx(model, pre_model, diff_model, atol=1e-3, frames=123, refer_frames=77):
+    # compares the graphs with the torch modules on random inputs, with lengths the export never saw
+    device = model.betas.device
+    c, refer, f0, uv, lengths, refer_lengths = dummy_inputs(model, batch=2, frames=frames, refer_frames=refer_frames, device=device)
+    lengths[1] = frames // 2
+    refer_lengths[1] = refer_frames // 2
+    f0_scale = torch.ones(c.shape[0], 1, device=device)
+    x = torch.randn(c.shape[0], model.dim, frames, device=device)
+    t = torch.tensor([999, 10], device=device)
+    data = (c, refer, f0, 0, 0, lengths, refer_lengths, uv)
+    errors = {}
+    with torch.no_grad():
+        for auto_predict_f0 in (False, True):
+            ref = model.pre_model.infer(data, auto_predict_f0=auto_predict_f0, f0_scale=f0_scale)
+            out = pre_model.infer(data, auto_predict_f0=auto_predict_f0, f0_scale=f0_scale)
+            errors[f"pre_model(auto_predict_f0={auto_predict_f0})"] = max((a - b).abs().max().item() for a, b in zip(ref, out))
+        content, audio_prompt = ref
+        # with the prompt of the torch model, as a speaker library passes it
+        out = pre_model.infer(data, auto_predict_f0=False, f0_scale=f0_scale, audio_prompt=audio_prompt)
+        errors["pre_model(audio_prompt)"] = (model.pre_model.infer(data, auto_predict_f0=False, f0_scale=f0_scale)[0] - out[0]).abs().max().item()
+        cond_data = (content, audio_prompt, lengths, refer_lengths)
+        ref_cond = model.diff_model.encode_cond(cond_data)
+        cond = diff_model.encode_cond(cond_data)
+        errors["diff_cond"] = max((a - b).abs().max().item() for a, b in zip([ref_cond[0], *ref_cond[1]], [cond[0], *cond[1]]))
+        errors["diff_step"] = (model.diff_model.forward_step(x, ref_cond, t) - diff_model.forward_step(x, ref_cond, t)).abs().max().item()
+    for name, error in errors.items():
+        logging.info(f"onnx {name} max abs error: {error:.2e}")
+    bad = {name: error for name, error in errors.items() if not error <= atol}
+    if bad:
+        raise RuntimeError(f"onnx graphs differ from the torch model by more than {atol}: {bad}")
+    return errors
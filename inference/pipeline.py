@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+# end of the items, passed on by the last worker of a stage
+DONE = object()
+
+
+class Failed:
+    # an exception of a stage, carried to the consumer in place of the item
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    # func(item) -> item of the next stage, run by workers threads
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.busy = 0.
+        self.items = 0
+
+
+class Pipeline:
+    # items pass the stages on worker threads joined by queues of queue_size, so every stage works on its next item
+    # while the following ones are busy. run yields the results in input order, utilization is the busy share per stage
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.start = self.end = None
+        self.stopped = False
+
+    def worker(self, stage, inbox, outbox, remaining):
+        # no_grad is per thread
+        with torch.no_grad():
+            while True:
+                item = inbox.get()
+                if item is DONE:
+                    with self.lock:
+                        remaining[stage.name] -= 1
+                        last = remaining[stage.name] == 0
+                    # the other workers of the stage still have to see it
+                    (outbox if last else inbox).put(DONE)
+                    return
+                index, value = item
+                if not isinstance(value, Failed) and not self.stopped:
+                    start = time.time()
+                    try:
+                        value = stage.func(value)
+                    except Exception as e:
+                        value = Failed(e)
+                    with self.lock:
+                        stage.busy += time.time() - start
+                        stage.items += 1
+                outbox.put((index, value))
+
+    def feed(self, items, inbox):
+        for index, item in enumerate(items):
+            if self.stopped:
+                break
+            inbox.put((index, item))
+        inbox.put(DONE)
+
+    def run(self, items):
+        self.start, self.end, self.stopped = time.time(), None, False
+        for stage in self.stages:
+            stage.busy, stage.items = 0., 0
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        remaining = {stage.name: stage.workers for stage in self.stages}
+        threading.Thread(target=self.feed, args=(items, queues[0]), daemon=True).start()
+        for stage, inbox, outbox in zip(self.stages, queues, queues[1:]):
+            for _ in range(stage.workers):
+                threading.Thread(target=self.worker, args=(stage, inbox, outbox, remaining), daemon=True).start()
+        # results of several workers can overtake each other
+        pending, next_index, item = {}, 0, None
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is DONE:
+                    break
+                index, value = item
+                pending[index] = value
+                while next_index in pending:
+                    value = pending.pop(next_index)
+                    next_index += 1
+                    if isinstance(value, Failed):
+                        raise value.error
+                    yield value
+        finally:
+            self.end = time.time()
+            if item is not DONE:
+                # stopped early, let the workers run dry instead of blocking on full queues
+                self.stopped = True
+                threading.Thread(target=self.drain, args=(queues[-1],), daemon=True).start()
+
+    @staticmethod
+    def drain(outbox):
+        while outbox.get() is not DONE:
+            pass
+
+    def utilization(self):
+        wall = (self.end or time.time()) - self.start
+        return {stage.name: stage.busy / (wall * stage.workers) for stage in self.stages}
+
+    def report(self):
+        wall = (self.end or time.time()) - self.start
+        busy = ", ".join(f"{name} {share:.0%}" for name, share in self.utilization().items())
+        print(f"pipeline {wall:.3f}s, busy {busy}")
+
+
+def segment_pipeline(svc, variants, audio_sr,
+                     pad_seconds=0.5,
+                     auto_predict_f0=False,
+                     F0_mean_pooling=False,
+                     cr_threshold=0.05,
+                     sample_method='ddim',
+                     sampling_timesteps=None,
+                     queue_size=2):
+    # plan_segments entries in, the converted audio of every (refer, audio_prompt, tran) variant out, None for silence.
+    # contentvec and f0 of the next segments and the vocoder of the last one run while the current one is sampled
+    sampling_timesteps = sampling_timesteps or svc.sampling_timesteps
+    pad_len = int(audio_sr * pad_seconds)
+    out_pad_len = int(svc.target_sample * pad_seconds)
+
+    def features(entry):
+        slice_tag, dat, length, crossfade = entry
+        print(f'#=====segment start, {round(len(dat) / audio_sr, 3)}s======')
+        if slice_tag:
+            print('jump empty segment')
+            return None
+        return svc.get_unit_f0((np.pad(dat, pad_len), audio_sr), 0, False, F0_mean_pooling, cr_threshold=cr_threshold)
+
+    def sample(unit_f0):
+        if unit_f0 is None:
+            return None
+        c, refer, f0, uv, lengths, refer_lengths, audio_prompt = svc.batch_variants(*unit_f0, variants)
+        start = time.time()
+        mel = svc.sample_mel(c, refer, f0, uv, lengths, refer_lengths, auto_predict_f0=auto_predict_f0,
+                             sampling_timesteps=sampling_timesteps, sample_method=sample_method,
+                             audio_prompt=audio_prompt)
+        print("ns2vc x{} use time:{}".format(len(variants), time.time() - start))
+        return mel
+
+    def vocode(mel):
+        if mel is None:
+            return None
+        audio = svc.vocoder.decode(mel).float().cpu().numpy()
+        return [row[out_pad_len:len(row) - out_pad_len] for row in audio]
+
+    return Pipeline([Stage("features", features), Stage("sample", sample), Stage("vocode", vocode)], queue_size)
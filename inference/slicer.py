@@ -1,4 +1,5 @@
 import librosa
+import numpy as np
 import torch
 import torchaudio
 
@@ -29,96 +30,195 @@ class Slicer:
         else:
             return waveform[begin * self.hop_size: min(waveform.shape[0], end * self.hop_size)]
 
-    # @timeit
+    def _silence(self, rms_list, offset, silence_start, i, clip_start):
+        # the (begin, end) frames to cut out of the silent frames silence_start..i-1, decided at the sounding frame i.
+        # None keeps the silence. rms_list starts at frame offset
+        is_leading_silence = silence_start == 0 and i > self.max_sil_kept
+        need_slice_middle = i - silence_start >= self.min_interval and i - clip_start >= self.min_length
+        if not is_leading_silence and not need_slice_middle:
+            return None
+
+        def argmin(begin, end):
+            return int(rms_list[begin - offset: end - offset].argmin()) + begin
+
+        if i - silence_start <= self.max_sil_kept:
+            pos = argmin(silence_start, i + 1)
+            if silence_start == 0:
+                return 0, pos
+            return pos, pos
+        elif i - silence_start <= self.max_sil_kept * 2:
+            pos = argmin(i - self.max_sil_kept, silence_start + self.max_sil_kept + 1)
+            pos_l = argmin(silence_start, silence_start + self.max_sil_kept + 1)
+            pos_r = argmin(i - self.max_sil_kept, i + 1)
+            if silence_start == 0:
+                return 0, pos_r
+            return min(pos_l, pos), max(pos_r, pos)
+        else:
+            pos_l = argmin(silence_start, silence_start + self.max_sil_kept + 1)
+            pos_r = argmin(i - self.max_sil_kept, i + 1)
+            if silence_start == 0:
+                return 0, pos_r
+            return pos_l, pos_r
+
+    def _trailing_silence(self, rms_list, offset, silence_start, total_frames):
+        if total_frames - silence_start < self.min_interval:
+            return None
+        silence_end = min(total_frames, silence_start + self.max_sil_kept)
+        pos = int(rms_list[silence_start - offset: silence_end + 1 - offset].argmin()) + silence_start
+        return pos, total_frames + 1
+
+    def _ranges(self, sil_tags, length, prev_end=None):
+        # [begin, end, silent] in samples of the silences sil_tags and the audio in front of each.
+        # prev_end is the end frame of the silence before sil_tags, None if there was none
+        ranges = []
+        for begin, end in sil_tags:
+            # a leading silence has nothing in front of it
+            if prev_end is not None or begin:
+                ranges.append((prev_end * self.hop_size if prev_end is not None else 0, min(length, begin * self.hop_size), 0))
+            ranges.append((begin * self.hop_size, min(length, end * self.hop_size), 1))
+            prev_end = end
+        return ranges
+
     def slice(self, waveform):
+        # int64 [begin, end, silent] sample ranges covering the waveform, silent ones are the silences cut out
         if len(waveform.shape) > 1:
             samples = librosa.to_mono(waveform)
         else:
             samples = waveform
-        if samples.shape[0] <= self.min_length:
-            return {"0": {"slice": False, "split_time": f"0,{len(waveform)}"}}
+        length = samples.shape[0]
+        if length <= self.min_length:
+            return np.array([[0, length, 0]], dtype=np.int64)
         rms_list = librosa.feature.rms(y=samples, frame_length=self.win_size, hop_length=self.hop_size).squeeze(0)
+        total_frames = rms_list.shape[0]
+        # runs of silent frames, a run is decided at the sounding frame that ends it
+        silent = np.concatenate([[False], rms_list < self.threshold, [False]])
+        edges = np.flatnonzero(silent[1:] != silent[:-1])
         sil_tags = []
-        silence_start = None
         clip_start = 0
-        for i, rms in enumerate(rms_list):
-            # Keep looping while frame is silent.
-            if rms < self.threshold:
-                # Record start of silent frames.
-                if silence_start is None:
-                    silence_start = i
-                continue
-            # Keep looping while frame is not silent and silence start has not been recorded.
-            if silence_start is None:
-                continue
-            # Clear recorded silence start if interval is not enough or clip is too short
-            is_leading_silence = silence_start == 0 and i > self.max_sil_kept
-            need_slice_middle = i - silence_start >= self.min_interval and i - clip_start >= self.min_length
-            if not is_leading_silence and not need_slice_middle:
-                silence_start = None
-                continue
-            # Need slicing. Record the range of silent frames to be removed.
-            if i - silence_start <= self.max_sil_kept:
-                pos = rms_list[silence_start: i + 1].argmin() + silence_start
-                if silence_start == 0:
-                    sil_tags.append((0, pos))
-                else:
-                    sil_tags.append((pos, pos))
-                clip_start = pos
-            elif i - silence_start <= self.max_sil_kept * 2:
-                pos = rms_list[i - self.max_sil_kept: silence_start + self.max_sil_kept + 1].argmin()
-                pos += i - self.max_sil_kept
-                pos_l = rms_list[silence_start: silence_start + self.max_sil_kept + 1].argmin() + silence_start
-                pos_r = rms_list[i - self.max_sil_kept: i + 1].argmin() + i - self.max_sil_kept
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                    clip_start = pos_r
-                else:
-                    sil_tags.append((min(pos_l, pos), max(pos_r, pos)))
-                    clip_start = max(pos_r, pos)
+        for silence_start, i in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            if i == total_frames:
+                tag = self._trailing_silence(rms_list, 0, silence_start, total_frames)
             else:
-                pos_l = rms_list[silence_start: silence_start + self.max_sil_kept + 1].argmin() + silence_start
-                pos_r = rms_list[i - self.max_sil_kept: i + 1].argmin() + i - self.max_sil_kept
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                else:
-                    sil_tags.append((pos_l, pos_r))
-                clip_start = pos_r
-            silence_start = None
-        # Deal with trailing silence.
-        total_frames = rms_list.shape[0]
-        if silence_start is not None and total_frames - silence_start >= self.min_interval:
-            silence_end = min(total_frames, silence_start + self.max_sil_kept)
-            pos = rms_list[silence_start: silence_end + 1].argmin() + silence_start
-            sil_tags.append((pos, total_frames + 1))
-        # Apply and return slices.
-        if len(sil_tags) == 0:
-            return {"0": {"slice": False, "split_time": f"0,{len(waveform)}"}}
+                tag = self._silence(rms_list, 0, silence_start, i, clip_start)
+                if tag is not None:
+                    clip_start = tag[1]
+            if tag is not None:
+                sil_tags.append(tag)
+        ranges = self._ranges(sil_tags, length)
+        # the last segment is not the end
+        end = sil_tags[-1][1] * self.hop_size if sil_tags else 0
+        if end < length:
+            ranges.append((end, length, 0))
+        return np.array(ranges, dtype=np.int64)
+
+
+class StreamingSlicer(Slicer):
+    # Slicer.slice over mono audio arriving in blocks, with the same cut points.
+    # push returns the segments whose boundaries are final as (begin, end, silent, samples), flush the rest.
+    # only the samples since the last cut and the rms of the current silence are held
+    def __init__(self, sr, *args, **kwargs):
+        super().__init__(sr, *args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        self.length = 0
+        # samples not framed yet, behind the centre padding of librosa.feature.rms
+        self.frame_buffer = np.zeros(self.win_size // 2, dtype=np.float32)
+        self.frames = 0
+        self.rms = np.zeros(0, dtype=np.float32)
+        self.rms_offset = 0
+        self.silence_start = None
+        self.clip_start = 0
+        # end frame of the last silence cut out
+        self.prev_end = None
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.audio_offset = 0
+
+    def _frames(self, samples):
+        self.frame_buffer = np.concatenate([self.frame_buffer, samples])
+        if len(self.frame_buffer) < self.win_size:
+            return np.zeros(0, dtype=np.float32)
+        n = (len(self.frame_buffer) - self.win_size) // self.hop_size + 1
+        rms = librosa.feature.rms(y=self.frame_buffer[:(n - 1) * self.hop_size + self.win_size], frame_length=self.win_size,
+                                  hop_length=self.hop_size, center=False).squeeze(0)
+        self.frame_buffer = self.frame_buffer[n * self.hop_size:]
+        return rms
+
+    def _process(self, rms):
+        # the frame loop of Slicer.slice with its state kept across blocks, returns the silences to cut out
+        sil_tags = []
+        first = self.frames
+        self.rms = np.concatenate([self.rms, rms])
+        self.frames += len(rms)
+        silent = rms < self.threshold
+        i = first
+        while True:
+            if self.silence_start is None:
+                quiet = np.flatnonzero(silent[i - first:])
+                if not len(quiet):
+                    break
+                self.silence_start = i = i + int(quiet[0])
+            loud = np.flatnonzero(~silent[i - first:])
+            if not len(loud):
+                break
+            i += int(loud[0])
+            tag = self._silence(self.rms, self.rms_offset, self.silence_start, i, self.clip_start)
+            self.silence_start = None
+            if tag is not None:
+                self.clip_start = tag[1]
+                sil_tags.append(tag)
+        # cut points are only searched within the current silence
+        keep = self.frames if self.silence_start is None else self.silence_start
+        self.rms = self.rms[keep - self.rms_offset:]
+        self.rms_offset = keep
+        return sil_tags
+
+    def _segments(self, ranges):
+        segments = [(begin, end, bool(silent), self.audio[begin - self.audio_offset:end - self.audio_offset])
+                    for begin, end, silent in ranges]
+        if ranges:
+            cut = ranges[-1][1] - self.audio_offset
+            self.audio = self.audio[cut:]
+            self.audio_offset += cut
+        return segments
+
+    def push(self, samples):
+        samples = np.asarray(samples, dtype=np.float32)
+        self.audio = np.concatenate([self.audio, samples])
+        self.length += len(samples)
+        sil_tags = self._process(self._frames(samples))
+        ranges = self._ranges(sil_tags, self.length, self.prev_end)
+        if sil_tags:
+            self.prev_end = sil_tags[-1][1]
+        return self._segments(ranges)
+
+    def flush(self):
+        sil_tags = self._process(self._frames(np.zeros(self.win_size // 2, dtype=np.float32)))
+        if self.length <= self.min_length:
+            ranges = [(0, self.length, 0)]
         else:
-            chunks = []
-            # The first segment is not the beginning of the audio.
-            if sil_tags[0][0]:
-                chunks.append(
-                    {"slice": False, "split_time": f"0,{min(waveform.shape[0], sil_tags[0][0] * self.hop_size)}"})
-            for i in range(0, len(sil_tags)):
-                # Mark audio segment. Skip the first segment.
-                if i:
-                    chunks.append({"slice": False,
-                                   "split_time": f"{sil_tags[i - 1][1] * self.hop_size},{min(waveform.shape[0], sil_tags[i][0] * self.hop_size)}"})
-                # Mark all mute segments
-                chunks.append({"slice": True,
-                               "split_time": f"{sil_tags[i][0] * self.hop_size},{min(waveform.shape[0], sil_tags[i][1] * self.hop_size)}"})
-            # The last segment is not the end.
-            if sil_tags[-1][1] * self.hop_size < len(waveform):
-                chunks.append({"slice": False, "split_time": f"{sil_tags[-1][1] * self.hop_size},{len(waveform)}"})
-            chunk_dict = {}
-            for i in range(len(chunks)):
-                chunk_dict[str(i)] = chunks[i]
-            return chunk_dict
+            if self.silence_start is not None:
+                tag = self._trailing_silence(self.rms, self.rms_offset, self.silence_start, self.frames)
+                if tag is not None:
+                    sil_tags.append(tag)
+            ranges = self._ranges(sil_tags, self.length, self.prev_end)
+            if sil_tags:
+                self.prev_end = sil_tags[-1][1]
+            # the last segment is not the end
+            end = self.prev_end * self.hop_size if self.prev_end is not None else 0
+            if end < self.length:
+                ranges.append((end, self.length, 0))
+        segments = self._segments(ranges)
+        self.reset()
+        return segments
 
 
-def cut(audio_path, db_thresh=-30, min_len=5000):
-    audio, sr = librosa.load(audio_path, sr=None)
+def load(audio_path):
+    # mono float32 at the file's own sample rate, the one decode of a source
+    return librosa.load(audio_path, sr=None)
+
+
+def cut_audio(audio, sr, db_thresh=-30, min_len=5000):
     slicer = Slicer(
         sr=sr,
         threshold=db_thresh,
@@ -128,15 +228,19 @@ def cut(audio_path, db_thresh=-30, min_len=5000):
     return chunks
 
 
+def cut(audio_path, db_thresh=-30, min_len=5000):
+    audio, sr = load(audio_path)
+    return cut_audio(audio, sr, db_thresh=db_thresh, min_len=min_len)
+
+
+def split(audio, chunks):
+    # (silent, view of audio) per [begin, end, silent] range, nothing is copied
+    return [(bool(silent), audio[begin:end]) for begin, end, silent in chunks if begin != end]
+
+
 def chunks2audio(audio_path, chunks):
-    chunks = dict(chunks)
     audio, sr = torchaudio.load(audio_path)
     if len(audio.shape) == 2 and audio.shape[1] >= 2:
         audio = torch.mean(audio, dim=0).unsqueeze(0)
     audio = audio.cpu().numpy()[0]
-    result = []
-    for k, v in chunks.items():
-        tag = v["split_time"].split(",")
-        if tag[0] != tag[1]:
-            result.append((v["slice"], audio[int(tag[0]):int(tag[1])]))
-    return result, sr
\ No newline at end of file
+    return split(audio, chunks), sr
@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+INDEX = "index.json"
+MELS = "mels.npy"
+PROMPTS = "prompts.npy"
+
+
+class SpeakerLibrary:
+    # reference mels and PromptEncoder outputs of named speakers, written by make_speaker_library.py.
+    # every speaker is a frame range of two arrays that are memory mapped, only the speakers used are read
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX)) as f:
+            self.index = json.load(f)
+        self.speakers = self.index["speakers"]
+        self.mels = np.load(os.path.join(path, MELS), mmap_mode="r")
+        self.prompts = np.load(os.path.join(path, PROMPTS), mmap_mode="r")
+
+    @property
+    def names(self):
+        return list(self.speakers)
+
+    def __contains__(self, name):
+        return name in self.speakers
+
+    def __len__(self):
+        return len(self.speakers)
+
+    def get(self, name, device="cpu"):
+        # refer 1 x n_mels x T and audio_prompt T x 1 x C, as Svc.get_refer and Pre_model.encode_prompt return them
+        if name not in self.speakers:
+            raise KeyError(f"speaker {name} is not in {self.path}")
+        entry = self.speakers[name]
+        frames = slice(entry["offset"], entry["offset"] + entry["frames"])
+        refer = torch.from_numpy(np.ascontiguousarray(self.mels[frames].T)).unsqueeze(0).to(device)
+        audio_prompt = torch.from_numpy(np.array(self.prompts[frames])).unsqueeze(1).to(device)
+        return refer, audio_prompt
+
+
+def build_library(svc, speakers, out_dir):
+    # speakers maps a name to its reference clips, the clips of one speaker are joined into one reference
+    mels, prompts, entries, offset = [], [], {}, 0
+    for name, clips in speakers.items():
+        refer = torch.cat([svc.get_refer(clip) for clip in clips], dim=2)
+        with torch.no_grad():
+            audio_prompt = svc.model.pre_model.encode_prompt(refer, torch.LongTensor([refer.shape[2]]).to(svc.dev))
+        mels.append(refer[0].T.float().cpu().numpy())
+        prompts.append(audio_prompt[:, 0].float().cpu().numpy())
+        entries[name] = {"offset": offset, "frames": refer.shape[2], "clips": [str(clip) for clip in clips]}
+        offset += refer.shape[2]
+        logging.info(f"{name}: {len(clips)} clips, {refer.shape[2]} frames")
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, MELS), np.concatenate(mels))
+    np.save(os.path.join(out_dir, PROMPTS), np.concatenate(prompts))
+    # the prompts belong to the prompt encoder of this model
+    with open(os.path.join(out_dir, INDEX), "w") as f:
+        json.dump({"model": str(svc.model_path), "speakers": entries}, f, indent=2)
+    return SpeakerLibrary(out_dir)
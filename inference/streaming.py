@@ -0,0 +1,139 @@
+import time
+
+import librosa
+import numpy as np
+import torch
+
+import utils
+
+
+class StreamingVC:
+    # push pcm in, pull converted pcm out, both mono float32 at the model sample rate.
+    # input is converted in blocks, each one together with `context` seconds of the input before it and
+    # `lookahead` seconds after it. The first `crossfade` seconds of the lookahead are converted twice and
+    # overlap-added, so a sample comes out block + lookahead seconds after it went in, plus compute time.
+    def __init__(self, svc, refer_path, tran=0,
+                 block_seconds=0.5,
+                 context_seconds=1.0,
+                 lookahead_seconds=0.1,
+                 crossfade_seconds=0.05,
+                 sample_method='dpmpp_2m',
+                 sampling_timesteps=10,
+                 auto_predict_f0=False,
+                 ):
+        self.svc = svc
+        self.sr = svc.target_sample
+        self.hop = svc.hop_size
+        # whole frames, so the features of a window line up with its samples
+        self.block = max(1, round(block_seconds * self.sr / self.hop)) * self.hop
+        self.context = round(context_seconds * self.sr / self.hop) * self.hop
+        self.lookahead = round(lookahead_seconds * self.sr / self.hop) * self.hop
+        self.crossfade = int(crossfade_seconds * self.sr)
+        assert self.crossfade <= self.lookahead, "the crossfade is taken from the lookahead"
+        assert self.crossfade <= self.block, "a crossfade longer than a block would overlap three blocks"
+        self.fade = np.linspace(0, 1, self.crossfade, dtype=np.float32)
+        self.tran = tran
+        self.sample_method = sample_method
+        self.sampling_timesteps = sampling_timesteps
+        self.auto_predict_f0 = auto_predict_f0
+
+        self.refer = svc.get_refer(refer_path)
+        self.refer_lengths = torch.LongTensor([self.refer.shape[2]]).to(svc.dev)
+        # the prompt encoder runs once per stream instead of once per block, the onnx graph always encodes it
+        encode_prompt = getattr(svc.model.pre_model, 'encode_prompt', None)
+        with torch.no_grad():
+            self.audio_prompt = encode_prompt(self.refer, self.refer_lengths) if encode_prompt else None
+        self.reset()
+
+    def reset(self):
+        # silence as the context of the first block
+        self.buffer = np.zeros(self.context, dtype=np.float32)
+        self.ready = []
+        self.tail = None
+        self.pushed = 0
+        self.emitted = 0
+        # interpolated f0 where the next window starts, carried over so unvoiced starts do not jump
+        self.next_f0 = 0.
+        # one pitch scale for the whole stream, offline inference draws one per call
+        self.f0_scale = torch.Tensor(1, 1).uniform_(0.8, 1.2).to(self.svc.dev)
+        self.block_times = []
+
+    @property
+    def window(self):
+        return self.context + self.block + self.lookahead
+
+    @property
+    def latency(self):
+        # algorithmic latency in seconds, the first sample of a block waits for the rest of it and the lookahead
+        return (self.block + self.lookahead) / self.sr
+
+    def push(self, pcm):
+        # converts every block that is complete, the time it takes is spent in the caller
+        pcm = np.asarray(pcm, dtype=np.float32)
+        self.pushed += len(pcm)
+        self._append(pcm)
+
+    def pull(self, max_samples=None):
+        # converted samples so far, at most max_samples of them
+        if not self.ready:
+            return np.zeros(0, dtype=np.float32)
+        out = np.concatenate(self.ready)
+        if max_samples is not None and len(out) > max_samples:
+            self.ready = [out[max_samples:]]
+            out = out[:max_samples]
+        else:
+            self.ready = []
+        return out
+
+    def flush(self):
+        # end of input, converts what is buffered against silence and returns everything not pulled yet
+        pending = len(self.buffer) - self.context
+        if pending > 0:
+            self._append(np.zeros(-pending % self.block + self.lookahead, dtype=np.float32))
+        out = self.pull()
+        # the zero padding came out too
+        extra = self.emitted - self.pushed
+        out = out[:len(out) - extra] if extra > 0 else out
+        self.reset()
+        return out
+
+    def _append(self, pcm):
+        self.buffer = np.concatenate([self.buffer, pcm])
+        while len(self.buffer) >= self.window:
+            self._convert(self.buffer[:self.window])
+            self.buffer = self.buffer[self.block:]
+
+    def _features(self, wav):
+        svc = self.svc
+        f0 = utils.compute_f0_parselmouth(wav, sampling_rate=self.sr, hop_length=self.hop)
+        voiced = f0[0] > 0
+        if not voiced and self.next_f0 > 0:
+            # leading unvoiced frames ramp from the previous block instead of taking the first voiced value
+            f0[0] = self.next_f0
+        f0, uv = utils.interpolate_f0(f0)
+        uv[0] = voiced
+        self.next_f0 = float(f0[self.block // self.hop])
+        f0 = torch.FloatTensor(f0).unsqueeze(0).to(svc.dev) * 2 ** (self.tran / 12)
+        uv = torch.FloatTensor(uv).unsqueeze(0).to(svc.dev)
+
+        wav16k = librosa.resample(wav, orig_sr=self.sr, target_sr=16000)
+        c = utils.get_hubert_content(svc.hubert_model, wav_16k_tensor=torch.from_numpy(wav16k).to(svc.dev))
+        c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[1]).unsqueeze(0)
+        return c, f0, uv
+
+    def _convert(self, wav):
+        start = time.time()
+        c, f0, uv = self._features(wav)
+        lengths = torch.LongTensor([c.shape[2]]).to(self.svc.dev)
+        with torch.no_grad():
+            audio = self.svc.sample(c, self.refer, f0, uv, lengths, self.refer_lengths,
+                                    auto_predict_f0=self.auto_predict_f0, sampling_timesteps=self.sampling_timesteps,
+                                    sample_method=self.sample_method, audio_prompt=self.audio_prompt,
+                                    f0_scale=self.f0_scale)[0].float().cpu().numpy()
+        out = audio[self.context:self.context + self.block + self.crossfade]
+        if self.tail is not None and self.crossfade:
+            out[:self.crossfade] = self.tail * (1 - self.fade) + out[:self.crossfade] * self.fade
+        self.ready.append(out[:self.block])
+        self.tail = out[self.block:]
+        self.emitted += self.block
+        self.block_times.append(time.time() - start)
@@ -0,0 +1,44 @@
+import torch
+from vocos import Vocos
+
+
+class Vocoder:
+    # vocos, moved to its device once and kept there, so it can run next to the sampler or on its own.
+    # mels longer than chunk_frames are decoded in chunks overlapping by overlap_frames. of every overlap the outer
+    # quarters are dropped and the middle half is crossfaded. the quarters are wider than the receptive field of
+    # vocos, so the result matches decoding the whole mel at once while the istft only ever sees one chunk
+    def __init__(self, device="cpu", vocos=None, chunk_frames=1024, overlap_frames=128):
+        assert chunk_frames > 2 * overlap_frames, "chunks have to be longer than two overlaps"
+        self.device = torch.device(device)
+        self.vocos = (vocos or Vocos.from_pretrained("charactr/vocos-mel-24khz")).to(self.device).eval()
+        self.hop_size = self.vocos.head.istft.hop_length
+        self.chunk_frames = chunk_frames
+        self.overlap_frames = overlap_frames
+        quarter = overlap_frames // 4
+        ramp = (overlap_frames - 2 * quarter) * self.hop_size
+        self.fade = torch.linspace(0, 1, ramp + 2, device=self.device)[1:-1]
+
+    @torch.no_grad()
+    def decode(self, mel):
+        # B x n_mels x T, a padded batch is fine, to B x T * hop_size on the vocoder device
+        mel = mel.to(self.device, torch.float32)
+        frames = mel.shape[2]
+        if frames <= self.chunk_frames:
+            return self.vocos.decode(mel)
+        hop = self.hop_size
+        skip = self.overlap_frames // 4 * hop
+        ramp = len(self.fade)
+        audio = torch.empty(mel.shape[0], frames * hop, device=self.device)
+        for start in range(0, frames, self.chunk_frames - self.overlap_frames):
+            end = min(start + self.chunk_frames, frames)
+            chunk = self.vocos.decode(mel[:, :, start:end])
+            if start == 0:
+                audio[:, :end * hop] = chunk
+            else:
+                begin = start * hop + skip
+                blend = audio[:, begin:begin + ramp]
+                blend.mul_(1 - self.fade).add_(chunk[:, skip:skip + ramp] * self.fade)
+                audio[:, begin + ramp:end * hop] = chunk[:, skip + ramp:]
+            if end == frames:
+                break
+        return audio
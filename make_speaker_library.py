@@ -0,0 +1,43 @@
+import logging
+import os
+
+from inference.infer_tool import Svc
+from inference.speaker_library import build_library
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='encode reference clips once into a speaker library, use it with infer.py -spk')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model, the library only fits this model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-i', '--input_dir', type=str, default="speakers",
+                        help='One folder per speaker, named after it, holding its reference clips.')
+    parser.add_argument('-o', '--out_dir', type=str, default="logs/speakers",
+                        help='Library folder.')
+    parser.add_argument('-d', '--device', type=str, default=None,
+                        help='Device used for encoding. None means auto selecting.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    speakers = {}
+    for name in sorted(os.listdir(args.input_dir)):
+        speaker_dir = os.path.join(args.input_dir, name)
+        if not os.path.isdir(speaker_dir) or name.startswith('.'):
+            continue
+        clips = [os.path.join(speaker_dir, f) for f in sorted(os.listdir(speaker_dir)) if f.endswith('.wav')]
+        if clips:
+            speakers[name] = clips
+    assert speakers, f"no speaker folders with wav files in {args.input_dir}"
+
+    svc_model = Svc(args.model_path, args.config_path, args.device)
+    library = build_library(svc_model, speakers, args.out_dir)
+    print(f"wrote {len(library)} speakers to {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,9 @@ from dataset import NS2VCDataset, TextAudioCollate
 import modules.commons as commons
 from accelerate import Accelerator
 from parametrizations import weight_norm
-from operations import OPERATIONS_ENCODER, MultiheadAttention, SinusoidalPositionalEmbedding
+import parametrize
+from torch.nn.utils.weight_norm import WeightNorm
+from operations import OPERATIONS_ENCODER, MultiheadAttention, SinusoidalPositionalEmbedding, sdpa_padding_mask
 from accelerate import DistributedDataParallelKwargs
 from ema_pytorch import EMA
 import math
@@ -100,13 +102,16 @@ class PhoneEncoder(nn.Module):
       hidden_channels=512,
       n_layers=6,
       p_dropout=0.2,
-      last_ln = True):
+      last_ln = True,
+      attention_window=None):
         super().__init__()
         self.arch = [8 for _ in range(n_layers)]
         self.num_layers = n_layers
         self.hidden_size = hidden_channels
         self.padding_idx = 0
         self.dropout = p_dropout
+        # None is full self attention, an int limits it to that many frames each side
+        self.attention_window = attention_window
         self.layers = nn.ModuleList([])
         self.layers.extend([
             TransformerEncoderLayer(self.arch[i], self.hidden_size, self.dropout)
@@ -131,8 +136,10 @@ class PhoneEncoder(nn.Module):
             x = x + f0
         x = x * (1 - encoder_padding_mask.float()).transpose(0, 1)[..., None]
         # encoder layers
+        attn_padding_mask = sdpa_padding_mask(encoder_padding_mask)
         for layer in self.layers:
-            x = layer(x, encoder_padding_mask=encoder_padding_mask)
+            x = layer(x, encoder_padding_mask=encoder_padding_mask, attn_padding_mask=attn_padding_mask,
+                      attention_window=self.attention_window)
 
         if self.last_ln:
             x = self.layer_norm(x)
@@ -145,13 +152,16 @@ class PromptEncoder(nn.Module):
       hidden_channels=512,
       n_layers=6,
       p_dropout=0.2,
-      last_ln = True):
+      last_ln = True,
+      attention_window=None):
         super().__init__()
         self.arch = [8 for _ in range(n_layers)]
         self.num_layers = n_layers
         self.hidden_size = hidden_channels
         self.padding_idx = 0
         self.dropout = p_dropout
+        # None is full self attention, an int limits it to that many frames each side
+        self.attention_window = attention_window
         self.layers = nn.ModuleList([])
         self.layers.extend([
             TransformerEncoderLayer(self.arch[i], self.hidden_size, self.dropout)
@@ -172,8 +182,10 @@ class PromptEncoder(nn.Module):
         x = self.pre(x, encoder_padding_mask=encoder_padding_mask)
         x = x * (1 - encoder_padding_mask.float()).transpose(0, 1)[..., None]
         # encoder layers
+        attn_padding_mask = sdpa_padding_mask(encoder_padding_mask)
         for layer in self.layers:
-            x = layer(x, encoder_padding_mask=encoder_padding_mask)
+            x = layer(x, encoder_padding_mask=encoder_padding_mask, attn_padding_mask=attn_padding_mask,
+                      attention_window=self.attention_window)
 
         if self.last_ln:
             x = self.layer_norm(x)
@@ -210,12 +222,15 @@ class F0Predictor(nn.Module):
         out_channels=1,
         attention_layers=10,
         n_heads=8,
-        p_dropout=0.5,):
+        p_dropout=0.5,
+        attention_chunk=None,):
         super().__init__()
         self.conv_blocks = nn.ModuleList()
         self.attn_blocks = nn.ModuleList()
         self.norm = nn.ModuleList()
         self.n_heads = n_heads
+        # queries per cross attention call, None attends the whole sequence at once
+        self.attention_chunk = attention_chunk
         self.act = nn.ModuleList()
         self.f0_prenet = ConvLayer(1, in_channels , kernel_size=3, dropout=p_dropout)
         self.pre = ConvLayer(in_channels, hidden_channels, kernel_size=5, dropout=p_dropout)
@@ -243,15 +258,15 @@ class F0Predictor(nn.Module):
         x = self.pre(x, x_mask)
         x = x.masked_fill(x_mask.t().unsqueeze(-1), 0)
         prompt = prompt.masked_fill(prompt_mask.t().unsqueeze(-1), 0)
-        cross_mask = ~einsum('b j, b k -> b j k', ~x_mask, ~prompt_mask).view(x.shape[1], 1, x_mask.shape[1], prompt_mask.shape[1]).   \
-            expand(-1, self.n_heads, -1, -1).reshape(x.shape[1] * self.n_heads, x_mask.shape[1], prompt_mask.shape[1])
+        attn_prompt_mask = sdpa_padding_mask(prompt_mask)
         for i in range(len(self.conv_blocks)):
             for conv in self.conv_blocks[i]:
                 x = conv(x, x_mask)
             x = self.norm[i](x)
-            residual = self.attn_blocks[i](x, prompt, prompt, key_padding_mask = prompt_mask)[0]
+            residual = self.attn_blocks[i](x, prompt, prompt, key_padding_mask = attn_prompt_mask,
+                                           query_chunk=self.attention_chunk)[0]
             x = x + residual
-        assert torch.isnan(x).any() == False
+        utils.numeric_guard.check('f0_predictor', x)
         x = x.masked_fill(x_mask.t().unsqueeze(-1), 0)
         x = self.proj(x, x_mask)
         x = x.masked_fill(x_mask.t().unsqueeze(-1), 0)
@@ -280,7 +295,7 @@ class PerceiverResampler(nn.Module):
         # x = rearrange(x, 'b c t -> t b c')
         latents = repeat(self.latents, 'n c -> b n c', b = batch).transpose(0, 1)
         latents = self.attn(latents, x, x, key_padding_mask=x_mask)[0] + latents
-        assert torch.isnan(latents).any() == False
+        utils.numeric_guard.check('perceiver_resampler', latents)
         # latents = rearrange(latents, 't b c -> b c t')
         return latents
 
@@ -395,19 +410,14 @@ class Diffusion_Encoder(nn.Module):
         for _ in range(n_layers//3)
     ])
     # print('prompt_proj params:', count_parameters(self.prompt_proj))
-  def forward(self, x, data, t):
-    assert torch.isnan(x).any() == False
+  def encode_cond(self, data):
+    # everything that depends neither on the noisy input nor on the diffusion step
     contentvec, prompt, contentvec_lengths, prompt_lengths = data
-    x = rearrange(x, 'b c t -> t b c')
-    # contentvec = rearrange(contentvec, 't b c -> b c t')
-    # prompt = rearrange(prompt, 't b c -> b c t')
-    _, b, _ = x.shape
-
-    t = self.time_mlp(t)
+    b = contentvec.shape[1]
 
-    x_mask = ~commons.sequence_mask(contentvec_lengths, x.size(0)).to(torch.bool)
+    x_mask = ~commons.sequence_mask(contentvec_lengths, contentvec.size(0)).to(torch.bool)
     prompt_mask = ~commons.sequence_mask(prompt_lengths, prompt.size(0)).to(torch.bool)
-    q_prompt_lengths = torch.Tensor([32 for _ in range(b)]).to(torch.long).to(x.device)
+    q_prompt_lengths = torch.full((b,), 32, dtype=torch.long, device=contentvec.device)
     q_prompt_mask = ~commons.sequence_mask(q_prompt_lengths, 32).to(torch.bool)
 
     # cross_mask = ~einsum('b j, b k -> b j k', ~q_prompt_mask, ~prompt_mask).view(x.shape[0], 1, q_prompt_mask.shape[1], prompt_mask.shape[1]).   \
@@ -415,6 +425,18 @@ class Diffusion_Encoder(nn.Module):
     prompt = self.resampler(prompt, x_mask = prompt_mask)
     # q_cross_mask = ~einsum('b j, b k -> b j k', ~x_mask, ~q_prompt_mask).view(x.shape[0], 1, x_mask.shape[1], q_prompt_mask.shape[1]).  \
     #     expand(-1, self.n_heads, -1, -1).reshape(x.shape[0] * self.n_heads, x_mask.shape[1], q_prompt_mask.shape[1])
+    prompts = [prompt_proj(prompt) for prompt_proj in self.prompt_proj]
+    return contentvec, prompts, x_mask, q_prompt_mask
+
+  def forward_step(self, x, cond, t):
+    utils.numeric_guard.check('diffusion_encoder.input', x)
+    contentvec, prompts, x_mask, q_prompt_mask = cond
+    x = rearrange(x, 'b c t -> t b c')
+    # contentvec = rearrange(contentvec, 't b c -> b c t')
+    # prompt = rearrange(prompt, 't b c -> b c t')
+
+    t = self.time_mlp(t)
+
     x = self.pre_conv(x)
     x = x.masked_fill(x_mask.t().unsqueeze(-1), 0)
     ##last time change to here
@@ -423,11 +445,11 @@ class Diffusion_Encoder(nn.Module):
         x, skip_connection = layer(x, diffusion_step=t, conditioner=contentvec, x_mask = x_mask)
         if lid % 3 == 2:
             j = (lid+1)//3-1
-            prompt_ = self.prompt_proj[j](prompt)
             x_t = x
-            prompt_t = prompt_
-            scale_shift = self.cross_attn[j](x_t, prompt_t, prompt_t, key_padding_mask=q_prompt_mask)[0]
-            assert torch.isnan(scale_shift).any() == False
+            prompt_t = prompts[j]
+            # the 32 resampled prompt latents have no padding, q_prompt_mask is all False
+            scale_shift = self.cross_attn[j](x_t, prompt_t, prompt_t)[0]
+            utils.numeric_guard.check('diffusion_encoder.cross_attn', scale_shift)
             scale_shift = self.film[j](scale_shift)
             scale_shift = scale_shift.masked_fill(x_mask.t().unsqueeze(-1), 0)
             scale, shift = scale_shift.chunk(2, dim=-1)
@@ -441,10 +463,13 @@ class Diffusion_Encoder(nn.Module):
     x = F.relu(x)
     x = self.proj(x)
     x = x.masked_fill(x_mask.t().unsqueeze(-1), 0)
-    assert torch.isnan(x).any() == False
+    utils.numeric_guard.check('diffusion_encoder.output', x)
     x = rearrange(x, 't b c -> b c t')
     return x
 
+  def forward(self, x, data, t):
+    return self.forward_step(x, self.encode_cond(data), t)
+
 class Pre_model(nn.Module):
     def __init__(self, cfg) -> None:
         super().__init__()
@@ -455,10 +480,13 @@ class Pre_model(nn.Module):
         print("f0 params:", count_parameters(self.f0_predictor))
         self.prompt_encoder = PromptEncoder(**self.cfg['prompt_encoder'])
         print("prompt params:", count_parameters(self.prompt_encoder))
+    def encode_prompt(self, refer_padded, refer_lengths):
+        # depends on the reference only, callers converting many sources with one reference can keep it
+        return self.prompt_encoder(normalize(refer_padded),refer_lengths)
     def forward(self,data):
         c_padded, refer_padded, f0_padded, spec_padded, wav_padded, lengths, refer_lengths, uv_padded = data
         c_mask = ~commons.sequence_mask(lengths, c_padded.size(0)).to(torch.bool)
-        audio_prompt = self.prompt_encoder(normalize(refer_padded),refer_lengths)
+        audio_prompt = self.encode_prompt(refer_padded, refer_lengths)
 
         lf0 = 2595. * torch.log10(1. + f0_padded.unsqueeze(1) / 700.) / 500
         norm_lf0 = utils.normalize_f0(lf0, uv_padded)
@@ -468,16 +496,20 @@ class Pre_model(nn.Module):
         content = self.phoneme_encoder(c_padded, lengths,utils.f0_to_coarse(f0_padded))
         
         return content, audio_prompt, lf0, lf0_pred
-    def infer(self, data,auto_predict_f0=None):
+    def infer(self, data,auto_predict_f0=None,f0_scale=None,audio_prompt=None):
         c_padded, refer_padded, f0_padded, spec_padded, wav_padded, lengths, refer_lengths, uv_padded = data
         c_mask = ~commons.sequence_mask(lengths, c_padded.size(0)).to(torch.bool)
-        audio_prompt = self.prompt_encoder(normalize(refer_padded),refer_lengths)
+        if audio_prompt is None:
+            audio_prompt = self.encode_prompt(refer_padded, refer_lengths)
 
         lf0 = 2595. * torch.log10(1. + f0_padded.unsqueeze(1) / 700.) / 500
-        norm_lf0 = utils.normalize_f0(lf0, uv_padded)
+        norm_lf0 = utils.normalize_f0(lf0, uv_padded, factor=f0_scale)
         lf0_pred = self.f0_predictor(c_padded, audio_prompt, norm_lf0, lengths, refer_lengths)
         f0_pred = (700 * (torch.pow(10, lf0_pred * 500 / 2595) - 1)).squeeze(1)
-        if auto_predict_f0 == False:
+        if isinstance(auto_predict_f0, torch.Tensor):
+            # traced graphs take the switch as an input
+            f0_pred = torch.where(auto_predict_f0, f0_pred, f0_padded)
+        elif auto_predict_f0 == False:
             f0_pred = f0_padded
         content = self.phoneme_encoder(c_padded, lengths,utils.f0_to_coarse(f0_pred))
         
@@ -645,81 +677,315 @@ class NaturalSpeech2(nn.Module):
         return pred_img, x_start
 
     @torch.no_grad()
-    def p_sample_loop(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True):
+    def p_sample_loop(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True, callback = None, audio_prompt = None, f0_scale = None):
         data = (content, refer, f0, 0, 0, lengths, refer_lengths, uv)
-        content, refer = self.pre_model.infer(data)
+        content, refer = self.pre_model.infer(data,auto_predict_f0=auto_predict_f0,f0_scale=f0_scale,audio_prompt=audio_prompt)
+        cond = self.diff_model.encode_cond((content,refer,lengths,refer_lengths))
         shape = (content.shape[1], self.dim, content.shape[0])
         batch, device = shape[0], refer.device
 
+        posterior_mean_coef1 = self.posterior_mean_coef1.tolist()
+        posterior_mean_coef2 = self.posterior_mean_coef2.tolist()
+        posterior_std = (0.5 * self.posterior_log_variance_clipped).exp().tolist()
+
         img = torch.randn(shape, device = device)
-        imgs = [img]
+        noise = torch.empty_like(img)
+        time_cond = torch.empty((batch,), device = device, dtype = torch.long)
+
+        for i, t in enumerate(tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps)):
+            x_start = self.diff_model.forward_step(img, cond, time_cond.fill_(t))
+            # posterior mean, plus noise if t > 0
+            img.mul_(posterior_mean_coef2[t]).add_(x_start, alpha = posterior_mean_coef1[t])
+            if t > 0:
+                img.add_(noise.normal_(), alpha = posterior_std[t])
+            if exists(callback):
+                callback(i, t, img, x_start)
 
-        x_start = None
+        ret = img
+        return ret
 
-        for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
-            img, x_start = self.p_sample(img, t, (content,refer,lengths,refer_lengths))
-            imgs.append(img)
+    @torch.no_grad()
+    def ddim_sample(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True, callback = None, audio_prompt = None, f0_scale = None):
+        data = (content, refer, f0, 0, 0, lengths, refer_lengths, uv)
+        content, refer = self.pre_model.infer(data,auto_predict_f0=auto_predict_f0,f0_scale=f0_scale,audio_prompt=audio_prompt)
+        cond = self.diff_model.encode_cond((content,refer,lengths,refer_lengths))
+        shape = (content.shape[1], self.dim, content.shape[0])
+        batch, device, eta = shape[0], refer.device, self.ddim_sampling_eta
+
+        times = self.sampling_times()
+        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
+        alphas_cumprod = self.alphas_cumprod.tolist()
+
+        img = torch.randn(shape, device = device)
+        noise = torch.empty_like(img)
+        time_cond = torch.empty((batch,), device = device, dtype = torch.long)
+
+        for i, (time, time_next) in enumerate(tqdm(time_pairs, desc = 'sampling loop time step')):
+            x_start = self.diff_model.forward_step(img, cond, time_cond.fill_(time))
+
+            if time_next < 0:
+                img.copy_(x_start)
+            else:
+                alpha = alphas_cumprod[time]
+                alpha_next = alphas_cumprod[time_next]
+
+                sigma = eta * math.sqrt((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha))
+                c = math.sqrt(1 - alpha_next - sigma ** 2)
+
+                # x_start * alpha_next.sqrt() + c * pred_noise, with pred_noise expanded in terms of img and x_start
+                sqrt_recip_alpha, sqrt_recipm1_alpha = math.sqrt(1. / alpha), math.sqrt(1. / alpha - 1)
+                img.mul_(c * sqrt_recip_alpha / sqrt_recipm1_alpha).add_(x_start, alpha = math.sqrt(alpha_next) - c / sqrt_recipm1_alpha)
+                if sigma > 0:
+                    img.add_(noise.normal_(), alpha = sigma)
+            if exists(callback):
+                callback(i, time, img, x_start)
 
         ret = img
         return ret
 
+    def sampling_times(self, sampling_timesteps = None):
+        # [T-1, ..., 0, -1] with sampling_timesteps model evaluations, -1 stands for the clean sample
+        sampling_timesteps = default(sampling_timesteps, self.sampling_timesteps)
+        times = torch.linspace(-1, self.num_timesteps - 1, steps = sampling_timesteps + 1)
+        return list(reversed(times.int().tolist()))
+
+    def solver_times(self, spacing = 'logsnr'):
+        # sampling_timesteps evaluations from T-1 down to 0 followed by -1, the last evaluation gives the clean sample
+        steps = self.sampling_timesteps
+        if steps > self.num_timesteps:
+            logging.warning(f'{steps} sampling steps for {self.num_timesteps} trained timesteps, sampling every timestep once')
+            steps = self.num_timesteps
+        if spacing == 'time':
+            times = torch.linspace(self.num_timesteps - 1, 0, steps = steps).round().long().tolist()
+        else:
+            # uniform in log snr, snapped to the closest trained timestep. only indices come out, so on the cpu
+            alphas_cumprod = self.alphas_cumprod.double().cpu()
+            log_snr = torch.log(alphas_cumprod) - torch.log1p(-alphas_cumprod)
+            targets = torch.linspace(log_snr[-1].item(), log_snr[0].item(), steps = steps, dtype = torch.float64)
+            times = (log_snr[None, :] - targets[:, None]).abs().argmin(dim = -1).tolist()
+        # neighbouring targets can snap to the same timestep, move them apart so the requested count is kept
+        times = sorted(times, reverse = True)
+        for i in range(1, steps):
+            times[i] = min(times[i], times[i - 1] - 1)
+        for i in reversed(range(steps)):
+            times[i] = max(times[i], steps - 1 - i, times[i + 1] + 1 if i + 1 < steps else 0)
+        return times + [-1]
+
+    def alphas_sigmas(self, times):
+        # x_t = alpha_t * x_start + sigma_t * noise, with alpha = 1 and sigma = 0 at time -1
+        alphas_cumprod = self.alphas_cumprod.tolist()
+        alphas = [math.sqrt(alphas_cumprod[t]) if t >= 0 else 1. for t in times]
+        sigmas = [math.sqrt(1. - alphas_cumprod[t]) if t >= 0 else 0. for t in times]
+        return alphas, sigmas
+
     @torch.no_grad()
-    def ddim_sample(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True):
+    def dpm_solver_sample(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True, callback = None, audio_prompt = None, f0_scale = None, order = 2):
+        # multistep DPM-Solver++ (data prediction)
         data = (content, refer, f0, 0, 0, lengths, refer_lengths, uv)
-        content, refer = self.pre_model.infer(data,auto_predict_f0=auto_predict_f0)
+        content, refer = self.pre_model.infer(data,auto_predict_f0=auto_predict_f0,f0_scale=f0_scale,audio_prompt=audio_prompt)
+        cond = self.diff_model.encode_cond((content,refer,lengths,refer_lengths))
         shape = (content.shape[1], self.dim, content.shape[0])
-        batch, device, total_timesteps, sampling_timesteps, eta = shape[0], refer.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta
+        batch, device = shape[0], refer.device
 
-        times = torch.linspace(-1, total_timesteps - 1, steps = sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
+        times = self.solver_times()
+        alphas, sigmas = self.alphas_sigmas(times)
+        lambdas = [math.log(alpha / sigma) if sigma > 0 else math.inf for alpha, sigma in zip(alphas, sigmas)]
 
         img = torch.randn(shape, device = device)
-        imgs = [img]
+        time_cond = torch.empty((batch,), device = device, dtype = torch.long)
+        x_starts = []
+
+        for i in tqdm(range(len(times) - 1), desc = 'sampling loop time step'):
+            time, time_next = times[i], times[i + 1]
+            x_start = self.diff_model.forward_step(img, cond, time_cond.fill_(time))
+            x_starts = (x_starts + [x_start])[-order:]
+
+            if time_next < 0:
+                img.copy_(x_start)
+            else:
+                # lower orders for the warmup and the last steps
+                step_order = min(order, len(x_starts), len(times) - 2 - i)
+                h = lambdas[i + 1] - lambdas[i]
+                phi_1 = math.expm1(-h)
+                alpha_phi_1 = alphas[i + 1] * phi_1
+                # coefficients of the last x_starts, newest first
+                if step_order == 1:
+                    coefs = [-alpha_phi_1]
+                elif step_order == 2:
+                    r0 = (lambdas[i] - lambdas[i - 1]) / h
+                    coefs = [-alpha_phi_1 - 0.5 * alpha_phi_1 / r0, 0.5 * alpha_phi_1 / r0]
+                else:
+                    r0 = (lambdas[i] - lambdas[i - 1]) / h
+                    r1 = (lambdas[i - 1] - lambdas[i - 2]) / h
+                    phi_2 = phi_1 / h + 1.
+                    phi_3 = phi_2 / h - 0.5
+                    # alpha * phi_2 * d1 - alpha * phi_3 * d2 = p * d1_0 + q * (d1_0 - d1_1)
+                    p = alphas[i + 1] * phi_2
+                    q = (p * r0 - alphas[i + 1] * phi_3) / (r0 + r1)
+                    coefs = [-alpha_phi_1 + (p + q) / r0, -(p + q) / r0 - q / r1, q / r1]
+                img.mul_(sigmas[i + 1] / sigmas[i])
+                for coef, prev_x_start in zip(coefs, reversed(x_starts)):
+                    img.add_(prev_x_start, alpha = coef)
+            if exists(callback):
+                callback(i, time, img, x_start)
+
+        ret = img
+        return ret
 
-        x_start = None
+    def unipc_update(self, img, x, x_starts, lambdas, alphas, sigmas, i, order, x_start_next = None):
+        # UniP (x_start_next is None) or UniC (bh2) update of x from times[i] to times[i + 1], written to img
+        h = lambdas[i + 1] - lambdas[i]
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        B_h = h_phi_1
+
+        rks = [(lambdas[i - k] - lambdas[i]) / h for k in range(1, order)] + [1.]
+        R, b = [], []
+        h_phi_k = h_phi_1 / hh - 1
+        factorial_k = 1
+        for k in range(1, order + 1):
+            R.append([rk ** (k - 1) for rk in rks])
+            b.append(h_phi_k * factorial_k / B_h)
+            factorial_k *= k + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_k
+        R, b = torch.tensor(R, dtype = torch.float64), torch.tensor(b, dtype = torch.float64)
+
+        if x_start_next is None:
+            rhos = [] if order == 1 else [0.5] if order == 2 else torch.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+        else:
+            rhos = [0.5] if order == 1 else torch.linalg.solve(R, b).tolist()
+
+        # x_t = sigma_t / sigma_s * x - alpha_t * h_phi_1 * m0 - alpha_t * B_h * sum_k rho_k * (m_k - m0) / r_k
+        alpha_B_h = alphas[i + 1] * B_h
+        coef_0 = -alphas[i + 1] * h_phi_1
+        torch.mul(x, sigmas[i + 1] / sigmas[i], out = img)
+        for k in range(1, order):
+            coef = alpha_B_h * rhos[k - 1] / rks[k - 1]
+            img.add_(x_starts[-(k + 1)], alpha = -coef)
+            coef_0 += coef
+        if x_start_next is not None:
+            img.add_(x_start_next, alpha = -alpha_B_h * rhos[-1])
+            coef_0 += alpha_B_h * rhos[-1]
+        img.add_(x_starts[-1], alpha = coef_0)
+        return img
 
-        for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
-            time_cond = torch.full((batch,), time, device = device, dtype = torch.long)
-            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, (content,refer,lengths,refer_lengths))
+    @torch.no_grad()
+    def unipc_sample(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True, callback = None, audio_prompt = None, f0_scale = None, order = 2):
+        # UniPC predictor-corrector, the corrector reuses the next model evaluation
+        data = (content, refer, f0, 0, 0, lengths, refer_lengths, uv)
+        content, refer = self.pre_model.infer(data,auto_predict_f0=auto_predict_f0,f0_scale=f0_scale,audio_prompt=audio_prompt)
+        cond = self.diff_model.encode_cond((content,refer,lengths,refer_lengths))
+        shape = (content.shape[1], self.dim, content.shape[0])
+        batch, device = shape[0], refer.device
+
+        times = self.solver_times()
+        alphas, sigmas = self.alphas_sigmas(times)
+        lambdas = [math.log(alpha / sigma) if sigma > 0 else math.inf for alpha, sigma in zip(alphas, sigmas)]
+
+        img = torch.randn(shape, device = device)
+        img_prev = torch.empty_like(img)
+        time_cond = torch.empty((batch,), device = device, dtype = torch.long)
+        x_starts = []
+        last_order = None
+
+        for i in tqdm(range(len(times) - 1), desc = 'sampling loop time step'):
+            time, time_next = times[i], times[i + 1]
+            x_start = self.diff_model.forward_step(img, cond, time_cond.fill_(time))
 
             if time_next < 0:
-                img = x_start
-                imgs.append(img)
-                continue
+                img.copy_(x_start)
+            else:
+                if i > 0:
+                    self.unipc_update(img, img_prev, x_starts, lambdas, alphas, sigmas, i - 1, last_order, x_start_next = x_start)
+                x_starts = (x_starts + [x_start])[-order:]
+                step_order = min(order, len(x_starts), len(times) - 2 - i)
+                img_prev.copy_(img)
+                self.unipc_update(img, img_prev, x_starts, lambdas, alphas, sigmas, i, step_order)
+                last_order = step_order
+            if exists(callback):
+                callback(i, time, img, x_start)
 
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
+        ret = img
+        return ret
 
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
+    @torch.no_grad()
+    def heun_sample(self, content, refer, lengths, refer_lengths, f0, uv, auto_predict_f0 = True, callback = None, audio_prompt = None, f0_scale = None):
+        # Heun's method on the probability flow ode in x / alpha and sigma / alpha, two model evaluations per step
+        data = (content, refer, f0, 0, 0, lengths, refer_lengths, uv)
+        content, refer = self.pre_model.infer(data,auto_predict_f0=auto_predict_f0,f0_scale=f0_scale,audio_prompt=audio_prompt)
+        cond = self.diff_model.encode_cond((content,refer,lengths,refer_lengths))
+        shape = (content.shape[1], self.dim, content.shape[0])
+        batch, device = shape[0], refer.device
 
-            noise = torch.randn_like(img)
+        times = self.solver_times(spacing = 'time')
+        alphas, sigmas = self.alphas_sigmas(times)
 
-            img = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
+        img = torch.randn(shape, device = device)
+        img_euler = torch.empty_like(img)
+        time_cond = torch.empty((batch,), device = device, dtype = torch.long)
 
-            imgs.append(img)
+        for i in tqdm(range(len(times) - 1), desc = 'sampling loop time step'):
+            time, time_next = times[i], times[i + 1]
+            x_start = self.diff_model.forward_step(img, cond, time_cond.fill_(time))
+
+            if time_next < 0:
+                img.copy_(x_start)
+            else:
+                # euler step x' = x + dt * d with d = (x - x_start) / s, x = img / alpha and s = sigma / alpha
+                s, s_next = sigmas[i] / alphas[i], sigmas[i + 1] / alphas[i + 1]
+                dt = s_next - s
+                scale = alphas[i + 1] / alphas[i]
+                torch.mul(img, scale * s_next / s, out = img_euler)
+                img_euler.add_(x_start, alpha = -alphas[i + 1] * dt / s)
+                x_start_next = self.diff_model.forward_step(img_euler, cond, time_cond.fill_(time_next))
+                # x + dt * (d + d') / 2 with d' = (x' - x_start_next) / s_next
+                img.mul_(scale * (1 + dt / 2 * ((1 + dt / s_next) / s + 1 / s_next)))
+                img.add_(x_start, alpha = -alphas[i + 1] * dt / 2 * (1 + dt / s_next) / s)
+                img.add_(x_start_next, alpha = -alphas[i + 1] * dt / (2 * s_next))
+            if exists(callback):
+                callback(i, time, img, x_start)
 
         ret = img
         return ret
 
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        # bake the weight norm into plain weights instead of recomputing it on every forward, outputs are bit-identical
+        for module in list(self.modules()):
+            if parametrize.is_parametrized(module):
+                for name in list(module.parametrizations.keys()):
+                    parametrize.remove_parametrizations(module, name, leave_parametrized=True)
+            for hook in list(module._forward_pre_hooks.values()):
+                if isinstance(hook, WeightNorm):
+                    nn.utils.remove_weight_norm(module, hook.name)
+        return self.eval()
+
     @torch.no_grad()
     def sample(self,
         c, refer, f0, uv, lengths, refer_lengths, vocos,
-        auto_predict_f0=True, sampling_timesteps=200, sample_method='ddim'
+        auto_predict_f0=True, sampling_timesteps=200, sample_method='ddim', callback=None,
+        audio_prompt=None, f0_scale=None
         ):
         self.sampling_timesteps = sampling_timesteps
         # sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        if sample_method == 'ddpm':
-            sample_fn = self.p_sample_loop
-        elif sample_method == 'ddim':
-            sample_fn = self.ddim_sample
-        audio = sample_fn(c, refer, lengths, refer_lengths, f0, uv, auto_predict_f0)
+        sample_fns = {
+            'ddpm': self.p_sample_loop,
+            'ddim': self.ddim_sample,
+            'dpmpp_2m': partial(self.dpm_solver_sample, order = 2),
+            'dpmpp_3m': partial(self.dpm_solver_sample, order = 3),
+            'unipc': self.unipc_sample,
+            'heun': self.heun_sample,
+        }
+        sample_fn = sample_fns[sample_method]
+        # callback(step, time, img, x_start) sees the live buffers, clone them to keep a trajectory
+        # audio_prompt is pre_model.encode_prompt(refer, refer_lengths) computed beforehand, f0_scale a fixed (b, 1) pitch scale
+        audio = sample_fn(c, refer, lengths, refer_lengths, f0, uv, auto_predict_f0, callback = callback,
+                          audio_prompt = audio_prompt, f0_scale = f0_scale)
 
         audio = denormalize(audio)
-        vocos.to(audio.device)
+        # vocos is expected on its device already, inference.vocoder.Vocoder keeps it there
+        if vocos is None:
+            return audio
         audio = vocos.decode(audio)
 
         if audio.ndim == 3:
@@ -735,7 +1001,46 @@ class NaturalSpeech2(nn.Module):
             extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
         )
 
-    def forward(self, data, vocos):
+    def distill_loss(self, data, teacher, sampling_timesteps):
+        # progressive distillation, one student ddim step from t to t_next has to land where two teacher steps land
+        c_padded, refer_padded, f0_padded, spec_padded, \
+        wav_padded, lengths, refer_lengths, uv_padded = data
+        b, d, n, device = *spec_padded.shape, spec_padded.device
+        x_mask = torch.unsqueeze(commons.sequence_mask(lengths, spec_padded.size(2)), 1).to(spec_padded.dtype)
+        x_start = normalize(spec_padded)*x_mask
+        with torch.no_grad():
+            content, refer, _, _ = teacher.pre_model(data)
+
+        times = torch.tensor(self.sampling_times(sampling_timesteps), device = device)
+        mid_times = torch.tensor(self.sampling_times(2 * sampling_timesteps)[1::2], device = device)
+        idx = torch.randint(0, sampling_timesteps, (b,), device = device)
+        t, t_mid, t_next = times[idx], mid_times[idx], times[idx + 1]
+
+        # time -1 is the clean sample
+        alphas_cumprod = F.pad(self.alphas_cumprod, (1, 0), value = 1.)
+        alpha, alpha_mid, alpha_next = (extract(alphas_cumprod, time + 1, x_start.shape).sqrt() for time in (t, t_mid, t_next))
+        sigma, sigma_mid, sigma_next = ((1. - extract(alphas_cumprod, time + 1, x_start.shape)).sqrt() for time in (t, t_mid, t_next))
+
+        noise = torch.randn_like(x_start)*x_mask
+        x = self.q_sample(x_start = x_start, t = t, noise = noise)
+        with torch.no_grad():
+            cond = teacher.diff_model.encode_cond((content,refer,lengths,refer_lengths))
+            x_start_teacher = teacher.diff_model.forward_step(x, cond, t)
+            x_mid = alpha_mid * x_start_teacher + sigma_mid / sigma * (x - alpha * x_start_teacher)
+            x_start_teacher = teacher.diff_model.forward_step(x_mid, cond, t_mid)
+            x_next = alpha_next * x_start_teacher + sigma_next / sigma_mid * (x_mid - alpha_mid * x_start_teacher)
+            target = (x_next - sigma_next / sigma * x) / (alpha_next - sigma_next / sigma * alpha)
+
+        model_out = self.diff_model(x,(content,refer,lengths,refer_lengths), t)
+        loss = F.mse_loss(model_out, target, reduction = 'none')
+        loss = reduce(loss, 'b ... -> b (...)', 'mean')
+        # truncated snr weighting
+        loss = loss * (alpha ** 2 / sigma ** 2).clamp(min = 1.).view(b, 1)
+        return loss.mean()
+
+    def forward(self, data, vocos, teacher = None, sampling_timesteps = None):
+        if exists(teacher):
+            return self.distill_loss(data, teacher, sampling_timesteps)
         c_padded, refer_padded, f0_padded, spec_padded, \
         wav_padded, lengths, refer_lengths, uv_padded = data
         b, d, n, device = *spec_padded.shape, spec_padded.device
@@ -789,7 +1094,7 @@ class Trainer(object):
         device = self.accelerator.device
 
         # model
-        self.vocos = Vocos.from_pretrained("charactr/vocos-mel-24khz")
+        self.vocos = Vocos.from_pretrained("charactr/vocos-mel-24khz").to(device)
         self.model = NaturalSpeech2(cfg=self.cfg).to(device)
         # sampling and training hyperparameters
 
@@ -799,6 +1104,8 @@ class Trainer(object):
         self.gradient_accumulate_every = self.cfg['train']['gradient_accumulate_every']
 
         self.train_num_steps = self.cfg['train']['train_num_steps']
+        # non-finite checks inside the model, counted on the device and reported with the losses
+        utils.numeric_guard.configure(self.cfg['train'].get('numeric_guard', 'off'), self.cfg['train'].get('numeric_guard_every', 100))
 
         # dataset and dataloader
         collate_fn = TextAudioCollate()
@@ -835,7 +1142,7 @@ class Trainer(object):
     def device(self):
         return self.accelerator.device
 
-    def save(self, milestone):
+    def save(self, milestone, sampling_timesteps = None):
         if not self.accelerator.is_local_main_process:
             return
 
@@ -846,6 +1153,8 @@ class Trainer(object):
             'ema': self.ema.state_dict(),
             'scaler': self.accelerator.scaler.state_dict() if exists(self.accelerator.scaler) else None,
         }
+        if exists(sampling_timesteps):
+            data['sampling_timesteps'] = sampling_timesteps
 
         torch.save(data, str(self.logs_folder / f'model-{milestone}.pt'))
 
@@ -859,7 +1168,11 @@ class Trainer(object):
         model.load_state_dict(data['model'])
 
         self.step = data['step']
-        self.opt.load_state_dict(data['opt'])
+        if any('.ffn_1.0.weight' in k for k in data['model']):
+            # the per tap ffn Linears are one conv now, their optimizer state no longer lines up
+            print('checkpoint has the old ffn layout, optimizer state is not restored')
+        else:
+            self.opt.load_state_dict(data['opt'])
         if self.accelerator.is_main_process:
             self.ema.load_state_dict(data["ema"])
 
@@ -882,6 +1195,7 @@ class Trainer(object):
 
                 total_loss = 0.
 
+                utils.numeric_guard.step = self.step
                 for _ in range(self.gradient_accumulate_every):
                     data = next(self.dl)
                     data = [d.to(device) for d in data]
@@ -915,6 +1229,10 @@ class Trainer(object):
 
                     scalar_dict = {"loss/diff": loss_diff, "loss/all": total_loss,
                                 "loss/f0": loss_f0,"loss/grad": grad_norm}
+                    numeric_counts = utils.numeric_guard.report()
+                    if numeric_counts:
+                        logger.warning(f"Non-finite values: {numeric_counts}, step: {self.step}")
+                    scalar_dict.update({f"numeric/{name}": count for name, count in numeric_counts.items()})
                     image_dict = {
                         "all/lf0": utils.plot_data_to_numpy(lf0[0, 0, :].cpu().numpy(),
                                                             lf0_pred[0, 0, :].detach().cpu().numpy()),
@@ -963,3 +1281,74 @@ class Trainer(object):
                 pbar.update(1)
 
         accelerator.print('training complete')
+
+    def distill(self, teacher_path):
+        # progressive distillation from the ema weights of teacher_path, halving the ddim steps every round
+        accelerator = self.accelerator
+        device = accelerator.device
+        distill_cfg = self.cfg['distill']
+
+        data = torch.load(teacher_path, map_location=device)
+        model = self.accelerator.unwrap_model(self.model)
+        model.load_state_dict(data['model'])
+        ema = EMA(model)
+        ema.to(device)
+        ema.load_state_dict(data["ema"])
+        teacher = ema.ema_model
+        teacher.eval()
+        teacher.requires_grad_(False)
+        # the student starts from the teacher and only its diffusion model is trained
+        model.load_state_dict(teacher.state_dict())
+        model.pre_model.requires_grad_(False)
+        sampling_timesteps = data.get('sampling_timesteps', distill_cfg['sampling_timesteps'])
+        self.step = 0
+
+        if accelerator.is_main_process:
+            self.ema = EMA(model, beta = self.cfg['train']['ema_decay'], update_every = self.cfg['train']['ema_update_every'])
+            self.ema.to(device)
+            logger = utils.get_logger(self.logs_folder)
+            writer = SummaryWriter(log_dir=self.logs_folder)
+
+        while sampling_timesteps // 2 >= distill_cfg['min_sampling_timesteps']:
+            sampling_timesteps //= 2
+            with tqdm(total = distill_cfg['steps_per_round'], disable = not accelerator.is_main_process) as pbar:
+                for _ in range(distill_cfg['steps_per_round']):
+                    utils.numeric_guard.step = self.step
+                    data = next(self.dl)
+                    data = [d.to(device) for d in data]
+
+                    with self.accelerator.autocast():
+                        loss = self.model(data, self.vocos, teacher = teacher, sampling_timesteps = sampling_timesteps)
+
+                    self.accelerator.backward(loss)
+                    accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
+                    pbar.set_description(f'{sampling_timesteps} steps, loss: {loss.item():.4f}')
+
+                    accelerator.wait_for_everyone()
+
+                    self.opt.step()
+                    self.opt.zero_grad()
+
+                    accelerator.wait_for_everyone()
+                    if accelerator.is_main_process:
+                        self.ema.update()
+                        if self.step % self.cfg['train']['log_interval'] == 0:
+                            logger.info(f"Distill loss: {loss.item()}, sampling steps: {sampling_timesteps}, step: {self.step}")
+                            numeric_counts = utils.numeric_guard.report()
+                            if numeric_counts:
+                                logger.warning(f"Non-finite values: {numeric_counts}, step: {self.step}")
+                            utils.summarize(
+                                writer=writer,
+                                global_step=self.step,
+                                scalars={f"distill/loss_{sampling_timesteps}": loss.item(),
+                                         **{f"numeric/{name}": count for name, count in numeric_counts.items()}}
+                            )
+                    self.step += 1
+                    pbar.update(1)
+
+            # the student of this round is the teacher of the next one
+            teacher.load_state_dict(model.state_dict())
+            if accelerator.is_main_process:
+                self.save(f'distill-{sampling_timesteps}', sampling_timesteps = sampling_timesteps)
+
+        accelerator.print('distillation complete')
@@ -301,6 +301,42 @@ class EncConvLayer(nn.Module):
         return x
 
 
+def sdpa_padding_mask(key_padding_mask):
+    # B x S padding mask (True at padding) -> B x 1 x 1 x S boolean mask of the keys F.scaled_dot_product_attention attends to
+    return (~key_padding_mask)[:, None, None, :]
+
+
+def _look_around(x, pad_value):
+    # B x blocks x w x ... -> B x blocks x 3w x ..., every block next to the one before and after it
+    pad = x.new_full((x.size(0), 1, *x.shape[2:]), pad_value)
+    x = torch.cat([pad, x, pad], dim=1)
+    return torch.cat([x[:, :-2], x[:, 1:-1], x[:, 2:]], dim=2)
+
+
+def local_attention(q, k, v, window, attn_mask=None, dropout_p=0.):
+    # sliding window self attention, every query sees the keys at most `window` frames away.
+    # q, k, v are B x H x T x D, attn_mask None or the B x 1 x 1 x T output of sdpa_padding_mask.
+    # queries go in blocks of `window` against the block before, their own and the one after,
+    # so the scores take B x H x T x 3 window instead of B x H x T x T
+    bsz, num_heads, length, head_dim = q.shape
+    blocks = -(-length // window)
+    pad = blocks * window - length
+    valid = q.new_ones(bsz, length, dtype=torch.bool) if attn_mask is None else attn_mask[:, 0, 0, :]
+    valid = _look_around(F.pad(valid, (0, pad), value=False).view(bsz, blocks, window), False)
+    q, k, v = (F.pad(y, (0, 0, 0, pad)).transpose(1, 2).reshape(bsz, blocks, window, num_heads, head_dim) for y in (q, k, v))
+    k, v = (_look_around(y, 0.) for y in (k, v))
+    # query i of a block against key j of its 3 blocks, j - window - i frames apart
+    offset = torch.arange(3 * window, device=q.device)[None, :] - window - torch.arange(window, device=q.device)[:, None]
+    # every query keeps itself, padded queries would otherwise attend to nothing and give nan
+    mask = (valid[:, :, None, :] & (offset.abs() <= window)) | (offset == 0)
+    q = q.permute(0, 1, 3, 2, 4).reshape(bsz * blocks, num_heads, window, head_dim)
+    k, v = (y.permute(0, 1, 3, 2, 4).reshape(bsz * blocks, num_heads, 3 * window, head_dim) for y in (k, v))
+    attn = F.scaled_dot_product_attention(q, k, v, attn_mask=mask.view(bsz * blocks, 1, window, 3 * window),
+                                          dropout_p=dropout_p)
+    attn = attn.view(bsz, blocks, num_heads, window, head_dim).permute(0, 2, 1, 3, 4)
+    return attn.reshape(bsz, num_heads, blocks * window, head_dim)[:, :, :length]
+
+
 class MultiheadAttention(nn.Module):
     def __init__(self, embed_dim, num_heads, kdim=None, vdim=None, dropout=0., bias=True,
                  add_bias_kv=False, add_zero_attn=False, self_attention=False,
@@ -375,19 +411,23 @@ class MultiheadAttention(nn.Module):
             query, key, value,
             key_padding_mask=None,
             incremental_state=None,
-            need_weights=True,
+            need_weights=False,
             static_kv=False,
             attn_mask=None,
             before_softmax=False,
             need_head_weights=False,
-            enc_dec_attn_constraint_mask=None
+            enc_dec_attn_constraint_mask=None,
+            attention_window=None,
+            query_chunk=None,
     ):
         """Input shape: Time x Batch x Channel
 
         Args:
             key_padding_mask (ByteTensor, optional): mask to exclude
                 keys that are pads, of shape `(batch, src_len)`, where
-                padding elements are indicated by 1s.
+                padding elements are indicated by 1s. Without weights it
+                can also be the output of `sdpa_padding_mask`, to convert
+                a mask shared by several layers once.
             need_weights (bool, optional): return the attention weights,
                 averaged over heads (default: False).
             attn_mask (ByteTensor, optional): typically used to
@@ -398,6 +438,12 @@ class MultiheadAttention(nn.Module):
             need_head_weights (bool, optional): return the attention
                 weights for each head. Implies *need_weights*. Default:
                 return the average attention weights over all heads.
+            attention_window (int, optional): self attention only sees
+                the keys at most this many frames away, in O(T * window)
+                memory (default: None, full attention).
+            query_chunk (int, optional): attend this many queries at a
+                time, bounds the memory of a long cross attention to
+                O(query_chunk * S) (default: None, all at once).
         """
         if need_head_weights:
             need_weights = True
@@ -406,6 +452,12 @@ class MultiheadAttention(nn.Module):
         assert embed_dim == self.embed_dim
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
 
+        if not need_weights and incremental_state is None and not static_kv and not before_softmax \
+                and attn_mask is None and enc_dec_attn_constraint_mask is None \
+                and self.bias_k is None and not self.add_zero_attn:
+            return self._sdpa_forward(query, key, value, key_padding_mask, attention_window, query_chunk), None
+        assert attention_window is None and query_chunk is None, 'only the fused attention path is windowed or chunked'
+
         if self.enable_torch_version and incremental_state is None and not static_kv:
             if self.qkv_same_dim:
                 return F.multi_head_attention_forward(query, key, value,
@@ -573,6 +625,31 @@ class MultiheadAttention(nn.Module):
 
         return attn, (attn_weights, attn_logits)
 
+    def _sdpa_forward(self, query, key, value, key_padding_mask, attention_window=None, query_chunk=None):
+        # fused attention kernels, the attention weights are never materialized
+        tgt_len, bsz, embed_dim = query.size()
+        if self.self_attention:
+            q, k, v = self.in_proj_qkv(query)
+        elif self.encoder_decoder_attention:
+            q, k, v = self.in_proj_q(query), self.in_proj_k(key), self.in_proj_v(key)
+        else:
+            q, k, v = self.in_proj_q(query), self.in_proj_k(key), self.in_proj_v(value)
+        # T x B x C -> B x H x T x D
+        q, k, v = (y.contiguous().view(y.size(0), bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3) for y in (q, k, v))
+        if key_padding_mask is not None and key_padding_mask.dim() == 2:
+            key_padding_mask = sdpa_padding_mask(key_padding_mask)
+        dropout_p = self.dropout if self.training else 0.
+        if attention_window is not None:
+            assert self.self_attention, 'attention_window is for self attention'
+            attn = local_attention(q, k, v, attention_window, key_padding_mask, dropout_p=dropout_p)
+        elif query_chunk is not None and tgt_len > query_chunk:
+            attn = torch.cat([F.scaled_dot_product_attention(q_, k, v, attn_mask=key_padding_mask, dropout_p=dropout_p)
+                              for q_ in q.split(query_chunk, dim=2)], dim=2)
+        else:
+            attn = F.scaled_dot_product_attention(q, k, v, attn_mask=key_padding_mask, dropout_p=dropout_p)
+        attn = attn.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(attn)
+
     def in_proj_qkv(self, query):
         return self._in_proj(query).chunk(3, dim=-1)
 
@@ -656,11 +733,25 @@ class TransformerFFNLayer(nn.Module):
                 assert padding == 'LEFT'
                 self.first_offset = -(kernel_size - 1)
             self.last_offset = self.first_offset + kernel_size - 1
-            self.ffn_1 = nn.ModuleList()
+            # all taps as one conv, weight is kernel x in x out, each tap initialized like a Linear
+            self.ffn_1 = ConvTBC(hidden_size, filter_size, kernel_size)
             for i in range(kernel_size):
-                self.ffn_1.append(Linear(hidden_size, filter_size, bias=(i == 0)))
+                nn.init.xavier_uniform_(self.ffn_1.weight.data[i])
+            nn.init.constant_(self.ffn_1.bias, 0.)
+            self._register_load_state_dict_pre_hook(self._linear_taps_compat_hook)
         self.ffn_2 = Linear(filter_size, hidden_size)
 
+    def _linear_taps_compat_hook(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # older checkpoints hold one Linear per tap in ffn_1.{i}, only ffn_1.0 with a bias.
+        # tap 0 was applied to the unshifted input, so it adds to the offset 0 tap and the first offset stays empty
+        if f"{prefix}ffn_1.0.weight" not in state_dict:
+            return
+        taps = [state_dict.pop(f"{prefix}ffn_1.{i}.weight").t() for i in range(self.kernel_size)]
+        taps[-self.first_offset] = taps[-self.first_offset] + taps[0]
+        taps[0] = torch.zeros_like(taps[0])
+        state_dict[f"{prefix}ffn_1.weight"] = torch.stack(taps)
+        state_dict[f"{prefix}ffn_1.bias"] = state_dict.pop(f"{prefix}ffn_1.0.bias")
+
     def forward(self, x, incremental_state=None):
         # x: T x B x C
         if incremental_state is not None:
@@ -675,13 +766,8 @@ class TransformerFFNLayer(nn.Module):
         if self.kernel_size == 1:
             x = self.ffn_1(x)
         else:
-            padded = F.pad(x, (0, 0, 0, 0, -self.first_offset, self.last_offset))
-            results = []
-            for i in range(self.kernel_size):
-                shifted = padded[i:x.size(0) + i] if i else x
-                results.append(self.ffn_1[i](shifted))
-            res = sum(results)
-            x = res * self.kernel_size ** -0.5
+            x = F.pad(x, (0, 0, 0, 0, -self.first_offset, self.last_offset))
+            x = self.ffn_1(x) * self.kernel_size ** -0.5
 
         if incremental_state is not None:
             x = x[-1:]
@@ -806,7 +892,8 @@ class EncSALayer(nn.Module):
             query=x,
             key=x,
             value=x,
-            key_padding_mask=encoder_padding_mask
+            key_padding_mask=kwargs.get('attn_padding_mask', encoder_padding_mask),
+            attention_window=kwargs.get('attention_window'),
         )
         x = F.dropout(x, self.dropout, training=self.training)
         x = residual + x
@@ -842,32 +929,15 @@ class EncLocalSALayer(nn.Module):
             self.layer_norm2.training = layer_norm_training
         residual = x
         x = self.layer_norm1(x)
-        states = []
-        T = x.shape[0]
-        all_neg_inf = fill_with_neg_inf2(x.new(T, T))
-        half_chunk_size = self.chunk_size // 2
-        attn_mask = torch.triu(all_neg_inf, half_chunk_size + 1) \
-                    + torch.tril(all_neg_inf, -half_chunk_size - 1)
-        encoder_padding_mask = encoder_padding_mask.data
-        for i in range(0, x.shape[0], half_chunk_size + 1):
-            k_start = max(0, i - half_chunk_size)
-            k_end = min(x.shape[0], i + self.chunk_size)
-            kv = x[k_start:k_end]
-            q = x[i:i + half_chunk_size + 1]
-
-            q_nonpadding = (1 - encoder_padding_mask[:, i:i + half_chunk_size + 1].float()).data
-            encoder_padding_mask_ = encoder_padding_mask[:, k_start:k_end].data
-            encoder_padding_mask_[q_nonpadding.sum(-1) == 0, :] = 0
-            x_, _, = self.self_attn(
-                query=q,
-                key=kv,
-                value=kv,
-                key_padding_mask=encoder_padding_mask_,
-                attn_mask=attn_mask[i:i + half_chunk_size + 1, k_start:k_end]
-            )
-            x_ = x_ * (1 - q_nonpadding.T[:, :, None])
-            states.append(x_)
-        x = torch.cat(states)
+        # keys at most half a chunk away
+        x, _, = self.self_attn(
+            query=x,
+            key=x,
+            value=x,
+            key_padding_mask=encoder_padding_mask,
+            attention_window=self.chunk_size // 2,
+        )
+        x = x * (1 - encoder_padding_mask.float()).transpose(0, 1)[..., None]
         x = F.dropout(x, self.dropout, training=self.training)
         x = residual + x
 
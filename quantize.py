@@ -0,0 +1,125 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.nn.utils.weight_norm import WeightNorm
+
+import operations
+from model import ConvTBC
+from operations import MultiheadAttention
+
+QUANTIZE_MODES = ['dynamic', 'weight']
+
+
+def _tbc_weight(conv):
+    # effective (kernel, in, out) weight, the parametrized weight norm already folds in through .weight
+    for hook in conv._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm):
+            return hook.compute_weight(conv)
+    return conv.weight
+
+
+class LinearConvTBC(nn.Module):
+    # ConvTBC as im2col followed by an nn.Linear, so the linear quantization applies to it
+    def __init__(self, conv):
+        super().__init__()
+        weight = _tbc_weight(conv).detach()
+        kernel_size, in_channels, out_channels = weight.shape
+        self.kernel_size = kernel_size
+        self.padding = conv.padding
+        self.linear = nn.Linear(kernel_size * in_channels, out_channels)
+        self.linear.weight.data.copy_(weight.permute(2, 0, 1).reshape(out_channels, -1))
+        self.linear.bias.data.copy_(conv.bias.detach())
+
+    def forward(self, input):
+        if self.kernel_size == 1 and self.padding == 0:
+            return self.linear(input)
+        x = F.pad(input, (0, 0, 0, 0, self.padding, self.padding))
+        # T x B x C x kernel -> T x B x (kernel C), the tap major order of the linear weight
+        x = x.unfold(0, self.kernel_size, 1).transpose(2, 3).flatten(2)
+        return self.linear(x)
+
+
+class QuantizableMultiheadAttention(MultiheadAttention):
+    # in_proj_weight split into q, k and v nn.Linear modules
+    def in_proj_qkv(self, query):
+        return self.q_proj(query), self.k_proj(query), self.v_proj(query)
+
+    def in_proj_q(self, query):
+        return self.q_proj(query)
+
+    def in_proj_k(self, key):
+        return self.k_proj(key)
+
+    def in_proj_v(self, value):
+        return self.v_proj(value)
+
+
+def _split_in_proj(attn):
+    if attn.qkv_same_dim:
+        weights = attn.in_proj_weight.detach().chunk(3)
+        del attn.in_proj_weight
+    else:
+        weights = [attn.q_proj_weight.detach(), attn.k_proj_weight.detach(), attn.v_proj_weight.detach()]
+        del attn.q_proj_weight, attn.k_proj_weight, attn.v_proj_weight
+    biases = [None] * 3 if attn.in_proj_bias is None else attn.in_proj_bias.detach().chunk(3)
+    attn.register_parameter('in_proj_bias', None)
+    for name, weight, bias in zip(['q_proj', 'k_proj', 'v_proj'], weights, biases):
+        linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+        linear.weight.data.copy_(weight)
+        if bias is not None:
+            linear.bias.data.copy_(bias)
+        setattr(attn, name, linear)
+    # F.multi_head_attention_forward would read in_proj_weight directly
+    attn.enable_torch_version = False
+    attn.__class__ = QuantizableMultiheadAttention
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    # symmetric per output channel int8 weight, activations stay in floating point,
+    # a quarter of the weight memory at about fp32 speed
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        weight = linear.weight.detach().float()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.
+        self.register_buffer('weight', torch.round(weight / scales[:, None]).to(torch.int8))
+        self.register_buffer('scales', scales)
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().float())
+
+    def forward(self, input):
+        # the per channel scale commutes with the matmul, torch._weight_int8pack_mm is far slower on cpu
+        x = F.linear(input, self.weight.to(input.dtype)).mul_(self.scales)
+        if self.bias is not None:
+            x = x + self.bias
+        return x
+
+
+def _replace(module, cls, fn):
+    for name, child in module.named_children():
+        if isinstance(child, cls):
+            setattr(module, name, fn(child))
+        else:
+            _replace(child, cls, fn)
+
+
+def prepare(model):
+    # ConvTBC and the attention input projections as nn.Linear, numerically the same model
+    _replace(model, (ConvTBC, operations.ConvTBC), LinearConvTBC)
+    for module in model.modules():
+        if isinstance(module, MultiheadAttention) and not isinstance(module, QuantizableMultiheadAttention):
+            _split_in_proj(module)
+    return model
+
+
+@torch.no_grad()
+def quantize(model, mode='dynamic'):
+    # int8 inference on cpu, in place
+    # dynamic: int8 weights and per batch int8 activations for every linear
+    # weight: int8 weights only, smaller but not faster
+    assert mode in QUANTIZE_MODES, mode
+    model = prepare(model.eval())
+    if mode == 'dynamic':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    _replace(model, nn.Linear, Int8WeightOnlyLinear)
+    return model
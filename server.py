@@ -0,0 +1,228 @@
+import asyncio
+import collections
+import io
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import soundfile
+import torch
+
+from inference.infer_tool import Svc
+
+logging.getLogger('numba').setLevel(logging.WARNING)
+
+Request = collections.namedtuple('Request', ['c', 'f0', 'uv', 'refer', 'audio_prompt', 'auto_predict_f0', 'future'])
+
+
+class InferenceServer:
+    # requests wait in a queue, whatever arrives within max_wait of the first one is converted as one padded batch
+    def __init__(self, svc, max_batch=8, max_wait_ms=20, sample_method='ddim', sampling_timesteps=None,
+                 feature_workers=2, max_prompts=256):
+        self.svc = svc
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.sample_method = sample_method
+        self.sampling_timesteps = sampling_timesteps or svc.sampling_timesteps
+        # hubert and f0 of the sources run next to the model, the model itself sees one batch at a time
+        self.feature_pool = ThreadPoolExecutor(feature_workers)
+        self.model_pool = ThreadPoolExecutor(1)
+        # refer path -> (mel, encoded prompt), shared by every request with that reference
+        self.prompts = collections.OrderedDict()
+        self.max_prompts = max_prompts
+        self.prompts_lock = threading.Lock()
+        self.queue = None
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'batches': 0,
+            'max_queue_depth': 0,
+            'prompt_cache_hits': 0,
+            'batch_sizes': collections.Counter(),
+        }
+
+    def prompt(self, refer_path):
+        with self.prompts_lock:
+            if refer_path in self.prompts:
+                self.prompts.move_to_end(refer_path)
+                self.stats['prompt_cache_hits'] += 1
+                return self.prompts[refer_path]
+            refer = self.svc.get_refer(refer_path)
+            encode_prompt = getattr(self.svc.model.pre_model, 'encode_prompt', None)
+            with torch.no_grad():
+                audio_prompt = encode_prompt(refer, torch.LongTensor([refer.shape[2]]).to(self.svc.dev)) if encode_prompt else None
+            self.prompts[refer_path] = refer, audio_prompt
+            if len(self.prompts) > self.max_prompts:
+                self.prompts.popitem(last=False)
+            return refer, audio_prompt
+
+    def features(self, source, refer_path, tran):
+        c, f0, uv = self.svc.get_unit_f0(source, tran, False, False)
+        return (c, f0, uv, *self.prompt(refer_path))
+
+    async def convert(self, source, refer_path, tran=0, auto_predict_f0=False):
+        loop = asyncio.get_running_loop()
+        c, f0, uv, refer, audio_prompt = await loop.run_in_executor(self.feature_pool, self.features, source, refer_path, tran)
+        future = loop.create_future()
+        await self.queue.put(Request(c, f0, uv, refer, audio_prompt, auto_predict_f0, future))
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue.qsize())
+        return await future
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # auto_predict_f0 is one switch for the whole batch
+            for flag in {r.auto_predict_f0 for r in batch}:
+                rows = [r for r in batch if r.auto_predict_f0 == flag]
+                self.stats['batches'] += 1
+                self.stats['batch_sizes'][len(rows)] += 1
+                try:
+                    audios = await loop.run_in_executor(self.model_pool, self.run_batch, rows)
+                except Exception as e:
+                    for r in rows:
+                        r.future.set_exception(e)
+                    continue
+                for r, audio in zip(rows, audios):
+                    r.future.set_result(audio)
+
+    def run_batch(self, rows):
+        dev = self.svc.dev
+        lengths = torch.LongTensor([r.c.shape[2] for r in rows]).to(dev)
+        refer_lengths = torch.LongTensor([r.refer.shape[2] for r in rows]).to(dev)
+        frames, refer_frames = int(lengths.max()), int(refer_lengths.max())
+        c = torch.zeros(len(rows), rows[0].c.shape[1], frames, device=dev)
+        f0 = torch.zeros(len(rows), frames, device=dev)
+        uv = torch.zeros(len(rows), frames, device=dev)
+        refer = torch.zeros(len(rows), rows[0].refer.shape[1], refer_frames, device=dev)
+        for i, r in enumerate(rows):
+            c[i, :, :r.c.shape[2]] = r.c[0]
+            f0[i, :r.f0.shape[1]] = r.f0[0]
+            uv[i, :r.uv.shape[1]] = r.uv[0]
+            refer[i, :, :r.refer.shape[2]] = r.refer[0]
+        audio_prompt = None
+        if rows[0].audio_prompt is not None:
+            # T x B x C, padded frames are masked by refer_lengths
+            audio_prompt = torch.zeros(refer_frames, len(rows), rows[0].audio_prompt.shape[2], device=dev)
+            for i, r in enumerate(rows):
+                audio_prompt[:r.audio_prompt.shape[0], i] = r.audio_prompt[:, 0]
+        with torch.no_grad():
+            audio = self.svc.sample(c, refer, f0, uv, lengths, refer_lengths, auto_predict_f0=rows[0].auto_predict_f0,
+                                    sampling_timesteps=self.sampling_timesteps, sample_method=self.sample_method,
+                                    audio_prompt=audio_prompt).float().cpu().numpy()
+        hop = self.svc.hop_size
+        return [audio[i, :int(lengths[i]) * hop] for i in range(len(rows))]
+
+    def get_stats(self):
+        sizes = self.stats['batch_sizes']
+        served = sum(size * n for size, n in sizes.items())
+        return {
+            **self.stats,
+            'queue_depth': self.queue.qsize(),
+            'mean_batch_size': served / max(self.stats['batches'], 1),
+            'batch_sizes': {str(size): n for size, n in sorted(sizes.items())},
+            'cached_prompts': len(self.prompts),
+        }
+
+    # http, one request per connection
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, content_type, payload = await self.route(*request_line[:2], body)
+        except Exception as e:
+            logging.exception('bad request')
+            status, content_type, payload = 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                     f'Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode())
+        writer.write(payload)
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return 200, 'application/json', json.dumps(self.get_stats()).encode()
+        if method == 'POST' and path == '/convert':
+            # {"source": wav path, "refer": wav path, "tran": semitones, "auto_predict_f0": bool}, answered with a wav
+            args = json.loads(body)
+            self.stats['requests'] += 1
+            try:
+                audio = await self.convert(args['source'], args['refer'], args.get('tran', 0), args.get('auto_predict_f0', False))
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.exception('conversion failed')
+                return 500, 'application/json', json.dumps({'error': str(e)}).encode()
+            wav = io.BytesIO()
+            soundfile.write(wav, audio, self.svc.target_sample, format='wav')
+            return 200, 'audio/wav', wav.getvalue()
+        return 404, 'application/json', json.dumps({'error': f'no route {method} {path}'}).encode()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f'serving on {unix_socket or f"http://{host}:{port}"}')
+        async with server:
+            await server.serve_forever()
+        batcher.cancel()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='local conversion server, concurrent requests are batched')
+    parser.add_argument('-m', '--model_path', type=str, default="logs/model-127.pt",
+                        help='Path to the model.')
+    parser.add_argument('-c', '--config_path', type=str, default="config.json",
+                        help='Path to the configuration file.')
+    parser.add_argument('-d', '--device', type=str, default=None,
+                        help='Device used for inference. None means auto selecting.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port to listen on.')
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Listen on this unix socket instead of host and port.')
+    parser.add_argument('--max_batch', type=int, default=8,
+                        help='Largest batch handed to the model.')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile the denoiser step for every batch size up to --max_batch at startup.')
+    parser.add_argument('--max_wait_ms', type=float, default=20,
+                        help='How long the first request of a batch waits for others.')
+    parser.add_argument('-sm', '--sample_method', type=str, default='ddim',
+                        help='Diffusion sampler.')
+    parser.add_argument('-st', '--sampling_timesteps', type=int, default=None,
+                        help='Number of sampling steps, defaults to the one stored in the model.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    svc_model = Svc(args.model_path, args.config_path, args.device,
+                    compile=args.compile, batch_sizes=range(1, args.max_batch + 1))
+    server = InferenceServer(svc_model, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms,
+                             sample_method=args.sample_method, sampling_timesteps=args.sampling_timesteps)
+    asyncio.run(server.serve(args.host, args.port, args.unix))
+
+
+if __name__ == '__main__':
+    main()
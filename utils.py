@@ -63,20 +63,56 @@ def deprecated(func):
         return func(*args, **kwargs)
     return new_func
 
-def normalize_f0(f0, uv, random_scale=True):
+class NumericGuard:
+    # counts non-finite values where check is called, without syncing the device
+    # mode 'off' runs nothing, 'sampled' checks every `every` steps, 'always' checks every step
+    def __init__(self, mode='off', every=100):
+        self.configure(mode, every)
+        self.step = 0
+        self.counts = {}
+
+    def configure(self, mode='off', every=100):
+        assert mode in ('off', 'sampled', 'always'), mode
+        self.mode = mode
+        self.every = every
+
+    @property
+    def active(self):
+        return self.mode == 'always' or (self.mode == 'sampled' and self.step % self.every == 0)
+
+    def check(self, name, x):
+        if not self.active:
+            return
+        bad = (~torch.isfinite(x.detach())).sum()
+        if name in self.counts:
+            self.counts[name] += bad
+        else:
+            self.counts[name] = bad
+
+    def report(self):
+        # the only host sync, returns and resets the non-zero counts
+        counts = {name: int(count) for name, count in self.counts.items()}
+        self.counts = {}
+        return {name: count for name, count in counts.items() if count > 0}
+
+
+numeric_guard = NumericGuard()
+
+
+def normalize_f0(f0, uv, random_scale=True, factor=None):
     # calculate means based on x_mask
     uv_sum = torch.sum(uv, dim=1, keepdim=True)
     uv_sum[uv_sum == 0] = 9999
     means = torch.sum(f0[:, 0, :] * uv, dim=1, keepdim=True) / uv_sum
 
-    if random_scale:
+    # factor is a (batch, 1) scale, drawn here unless the caller passes one
+    if factor is None and random_scale:
         factor = torch.Tensor(f0.shape[0], 1).uniform_(0.8, 1.2).to(f0.device)
-    else:
+    elif factor is None:
         factor = torch.ones(f0.shape[0], 1).to(f0.device)
     # normalize f0 based on means and factor
     f0_norm = (f0 - means.unsqueeze(-1)) * factor.unsqueeze(-1)
-    if torch.isnan(f0_norm).any():
-        exit(0)
+    numeric_guard.check('normalize_f0', f0_norm)
     return f0_norm
 
 def compute_f0_uv_torchcrepe(wav_numpy, p_len=None, sampling_rate=44100, hop_length=512,device=None,cr_threshold=0.05):